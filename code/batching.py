@@ -0,0 +1,207 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+import threading
+
+import numpy as np
+import six
+from six.moves import queue
+
+
+def batch_count(num_examples, batch_size, last_batch="keep"):
+    """
+    Batches an epoch of num_examples is cut into under a sampler's last_batch policy
+    """
+    if last_batch == "drop":
+        return num_examples // batch_size
+    return -(-num_examples // batch_size)
+
+
+def finish_last_batch(batches, order, batch_size, last_batch="keep"):
+    """
+    Applies last_batch to a list of batches whose last one may be short: "keep" it, "drop" it,
+    or "pad" it with indices from the start of order, the epoch's example order
+    """
+    assert last_batch in ("keep", "drop", "pad")
+    if batches and len(batches[-1]) < batch_size:
+        if last_batch == "drop":
+            batches.pop()
+        elif last_batch == "pad":
+            batches[-1] = np.concatenate([batches[-1], np.resize(order, batch_size - len(batches[-1]))])
+    return batches
+
+
+class EpochSampler(object):
+    """
+    Yields batches of example indices that cover every index once per epoch, in a new random
+    order each epoch. The last batch is kept short (last_batch="keep"), dropped ("drop"), or
+    filled up with indices from the start of the epoch ("pad").
+    """
+    def __init__(self, indices, batch_size, last_batch="keep", seed=None):
+        assert last_batch in ("keep", "drop", "pad")
+        self.indices = np.asarray(indices)
+        self.batch_size = batch_size
+        self.last_batch = last_batch
+        self.rng = np.random.RandomState(seed)
+
+    def __len__(self):
+        return batch_count(len(self.indices), self.batch_size, self.last_batch)
+
+    def __iter__(self):
+        order = self.indices[self.rng.permutation(len(self.indices))]
+        for start in range(0, len(self) * self.batch_size, self.batch_size):
+            batch = order[start : start + self.batch_size]
+            if len(batch) < self.batch_size and self.last_batch == "pad":
+                batch = np.concatenate([batch, np.resize(order, self.batch_size - len(batch))])
+            yield batch
+
+
+class BucketSampler(object):
+    """
+    Yields batches of example indices whose paragraphs have similar lengths, so that padding
+    each batch to its own longest paragraph wastes little of the Match-LSTM recurrence.
+
+    Every epoch the examples are shuffled, cut into pools of pool_batches batches, sorted by
+    length inside each pool and split into batches; the batch order is then shuffled again.
+    Pools hold a whole number of batches, so only the last batch of an epoch can be smaller;
+    last_batch keeps, drops or pads it as in EpochSampler.
+    """
+    def __init__(self, lengths, batch_size, indices=None, pool_batches=50, last_batch="keep", seed=None):
+        assert last_batch in ("keep", "drop", "pad")
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.indices = np.arange(len(self.lengths)) if indices is None else np.asarray(indices)
+        self.pool_size = batch_size * pool_batches
+        self.last_batch = last_batch
+        self.rng = np.random.RandomState(seed)
+
+    def __len__(self):
+        return batch_count(len(self.indices), self.batch_size, self.last_batch)
+
+    def __iter__(self):
+        order = self.indices[self.rng.permutation(len(self.indices))]
+        batches = []
+        for start in range(0, len(order), self.pool_size):
+            pool = order[start : start + self.pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind = "mergesort")]
+            batches.extend(pool[i : i + self.batch_size] for i in range(0, len(pool), self.batch_size))
+        finish_last_batch(batches, order, self.batch_size, self.last_batch)
+
+        for i in self.rng.permutation(len(batches)):
+            yield batches[i]
+
+
+class ParagraphSampler(object):
+    """
+    Yields batches of example indices in which questions about the same paragraph are next to
+    each other, so a batch holds few distinct paragraphs and each is encoded once for all of
+    its questions (see QASystem.prepare_feed).
+
+    Every epoch the paragraphs are shuffled and their questions laid out one paragraph after
+    the other, in random order within a paragraph. Given lengths (of each example's paragraph),
+    the paragraphs are also sorted by length inside pools of pool_batches batches, as in
+    BucketSampler. The layout is then cut into batches, whose order is shuffled again.
+    Only the last batch of an epoch can be smaller; last_batch keeps, drops or pads it as in
+    EpochSampler.
+    """
+    def __init__(self, context_ids, batch_size, indices=None, lengths=None, pool_batches=50, last_batch="keep", seed=None):
+        assert last_batch in ("keep", "drop", "pad")
+        context_ids = np.asarray(context_ids)
+        self.indices = np.arange(len(context_ids)) if indices is None else np.asarray(indices)
+        self.batch_size = batch_size
+        self.pool_size = batch_size * pool_batches
+        self.last_batch = last_batch
+        self.rng = np.random.RandomState(seed)
+
+        # Paragraph (numbered 0..num_paragraphs-1) of each of self.indices, and each paragraph's size and length
+        _, self.paragraphs = np.unique(context_ids[self.indices], return_inverse = True)
+        self.sizes = np.bincount(self.paragraphs)
+        self.lengths = None
+        if lengths is not None:
+            self.lengths = np.zeros(len(self.sizes), dtype = np.asarray(lengths).dtype)
+            self.lengths[self.paragraphs] = np.asarray(lengths)[self.indices]
+
+    def __len__(self):
+        return batch_count(len(self.indices), self.batch_size, self.last_batch)
+
+    def __iter__(self):
+        rank = self.rng.permutation(len(self.sizes))        # Position of each paragraph in the epoch
+        if self.lengths is None:
+            pool = np.zeros(len(self.sizes), dtype = np.int64)
+            length = pool
+        else:
+            # Pool of a paragraph: where its first question would be placed, in pools of pool_size questions
+            by_rank = np.argsort(rank)
+            pool = np.empty(len(self.sizes), dtype = np.int64)
+            pool[by_rank] = (np.cumsum(self.sizes[by_rank]) - self.sizes[by_rank]) // self.pool_size
+            length = self.lengths
+
+        # Sorted by pool, then paragraph length, then paragraph; random within a paragraph
+        order = np.lexsort((self.rng.rand(len(self.indices)), rank[self.paragraphs], length[self.paragraphs], pool[self.paragraphs]))
+        order = self.indices[order]
+        batches = [order[start : start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+        finish_last_batch(batches, order, self.batch_size, self.last_batch)
+
+        for i in self.rng.permutation(len(batches)):
+            yield batches[i]
+
+
+class BatchPrefetcher(object):
+    """
+    Runs prepare on each batch of batches in a background thread, keeping up to capacity
+    prepared batches queued, and yields them in order. wait_time adds up how long the
+    consumer was blocked on the queue, i.e. how long the training step waited for data.
+    """
+    def __init__(self, batches, prepare, capacity=4):
+        self.queue = queue.Queue(maxsize = capacity)
+        self.wait_time = 0.0
+        self.thread = threading.Thread(target = self._produce, args = (batches, prepare))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _produce(self, batches, prepare):
+        try:
+            for batch in batches:
+                self.queue.put(("batch", (batch, prepare(batch))))
+        except Exception:
+            self.queue.put(("error", sys.exc_info()))     # Re-raised by the consumer
+            return
+        self.queue.put(("end", None))
+
+    def __iter__(self):
+        while True:
+            tic = time.time()
+            kind, item = self.queue.get()
+            self.wait_time += time.time() - tic
+            if kind == "end":
+                return
+            if kind == "error":
+                six.reraise(*item)
+            yield item
+
+
+class PaddingReport(object):
+    """
+    Counts real tokens against padding tokens over an epoch, for batches padded to their
+    longest example and for the fixed max_question_size/max_paragraph_size padding
+    """
+    def __init__(self, max_question_size, max_paragraph_size):
+        self.max_question_size = max_question_size
+        self.max_paragraph_size = max_paragraph_size
+        self.tokens = 0
+        self.padded = 0
+        self.fixed = 0
+
+    def add(self, question_lengths, paragraph_lengths):
+        for lengths, max_size in [(question_lengths, self.max_question_size), (paragraph_lengths, self.max_paragraph_size)]:
+            self.tokens += int(np.sum(lengths))
+            self.padded += int(len(lengths) * np.max(lengths))
+            self.fixed += len(lengths) * max_size
+
+    def summary(self):
+        return "Tokens processed: %d, padding processed: %d (%.1f%%), padding with fixed-size batches: %d (%.1f%%)" % (
+            self.tokens, self.padded - self.tokens, 100.0 * (self.padded - self.tokens) / max(self.padded, 1),
+            self.fixed - self.tokens, 100.0 * (self.fixed - self.tokens) / max(self.fixed, 1))
@@ -0,0 +1,170 @@
+"""
+Timings of parts of the model graph on random inputs, so no data or checkpoint is needed:
+
+    python code/benchmark.py --benchmark=match_lstm
+    python code/benchmark.py --benchmark=loss
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import logging
+import time
+
+import numpy as np
+from six.moves import xrange  # pylint: disable=redefined-builtin
+import tensorflow as tf
+
+from qa_model import Encoder
+
+logging.basicConfig(level=logging.INFO)
+
+tf.app.flags.DEFINE_string("benchmark", "match_lstm", "Which benchmark to run: match_lstm, loss")
+tf.app.flags.DEFINE_integer("batch_size", 32, "Batch size.")
+tf.app.flags.DEFINE_integer("state_size", 150, "Size of each model layer.")
+tf.app.flags.DEFINE_integer("embedding_size", 300, "Size of the word vectors.")
+tf.app.flags.DEFINE_integer("paragraph_size", 300, "Paragraph length of every example.")
+tf.app.flags.DEFINE_integer("question_size", 20, "Question length of every example.")
+tf.app.flags.DEFINE_integer("steps", 10, "Timed session.run calls per measurement (after one warm-up call); the median is reported.")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def model_flags(**overrides):
+    """
+    The parsed flags with some values replaced, for building several variants of a graph
+    """
+    values = dict(FLAGS.__flags)
+    values.update(max_paragraph_size=FLAGS.paragraph_size, max_question_size=FLAGS.question_size)
+    values.update(overrides)
+    return argparse.Namespace(**values)
+
+
+def time_runs(runs, steps):
+    """
+    Times several (session, fetches, feed) runs round-robin, so that load changes on the
+    machine hit all of them alike
+    :return: median seconds per session.run of each run, after one warm-up call
+    """
+    times = [[] for _ in runs]
+    for session, fetches, feed in runs:
+        session.run(fetches, feed)
+    for _ in xrange(steps):
+        for run_times, (session, fetches, feed) in zip(times, runs):
+            tic = time.time()
+            session.run(fetches, feed)
+            run_times.append(time.time() - tic)
+    return [np.median(run_times) for run_times in times]
+
+
+def benchmark_match_lstm():
+    """
+    Forward and forward+backward time of Encoder.encode with and without fast_match_lstm
+    """
+    rng = np.random.RandomState(0)
+    B, P, Q, E = FLAGS.batch_size, FLAGS.paragraph_size, FLAGS.question_size, FLAGS.embedding_size
+    questions = rng.randn(B, Q, E).astype(np.float32)
+    paragraphs = rng.randn(B, P, E).astype(np.float32)
+
+    runs = []
+    for fast in [False, True]:
+        graph = tf.Graph()
+        with graph.as_default():
+            question = tf.placeholder(tf.float32, (None, None, E))
+            paragraph = tf.placeholder(tf.float32, (None, None, E))
+            question_length = tf.placeholder(tf.int32, (None))
+            paragraph_length = tf.placeholder(tf.int32, (None))
+            encoder = Encoder(size=FLAGS.state_size, vocab_dim=E, FLAGS=model_flags(fast_match_lstm=fast))
+            HR = encoder.encode(question, paragraph, question_length, paragraph_length)
+            grads = tf.gradients(tf.reduce_sum(HR), tf.trainable_variables())
+            init = tf.global_variables_initializer()
+
+        session = tf.Session(graph=graph)
+        session.run(init)
+        feed = {question: questions, paragraph: paragraphs, question_length: [Q] * B, paragraph_length: [P] * B}
+        runs.extend([(session, HR, feed), (session, grads, feed)])
+
+    times = time_runs(runs, FLAGS.steps)
+    for fast, forward, backward in [(False, times[0], times[1]), (True, times[2], times[3])]:
+        logging.info("fast_match_lstm=%s: forward %.1f ms/batch (%.3f ms/time step), forward+backward %.1f ms/batch (%.3f ms/time step)" % (
+            fast, 1000 * forward, 1000 * forward / P, 1000 * backward, 1000 * backward / P))
+
+
+def unstacked_loss(pred_s, pred_e, paragraph_mask, start_answer, end_answer, batch_size):
+    """
+    The loss as QASystem.setup_loss used to build it: one boolean_mask and one cross-entropy
+    per example, for exactly batch_size examples
+    """
+    start_predictions = tf.unstack(pred_s, batch_size)
+    end_predictions = tf.unstack(pred_e, batch_size)
+    masks = tf.unstack(paragraph_mask, batch_size)
+
+    masked_preds_s = [tf.boolean_mask(p, mask) for p, mask in zip(start_predictions, masks)]
+    masked_preds_e = [tf.boolean_mask(p, mask) for p, mask in zip(end_predictions, masks)]
+
+    loss_list_1 = [tf.nn.sparse_softmax_cross_entropy_with_logits(masked_preds_s[i], start_answer[i]) for i in range(len(masked_preds_s))]
+    loss_list_2 = [tf.nn.sparse_softmax_cross_entropy_with_logits(masked_preds_e[i], end_answer[i]) for i in range(len(masked_preds_e))]
+    return tf.reduce_mean(loss_list_1) + tf.reduce_mean(loss_list_2)
+
+
+def masked_loss(pred_s, pred_e, paragraph_mask, start_answer, end_answer):
+    """
+    The loss as QASystem.setup_loss builds it: one masked cross-entropy over the whole batch
+    """
+    mask_term = (tf.cast(paragraph_mask, tf.float32) - 1) * 1e30
+    l1 = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(pred_s + mask_term, start_answer))
+    l2 = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(pred_e + mask_term, end_answer))
+    return l1 + l2
+
+
+def benchmark_loss():
+    """
+    Graph construction time and loss+gradient time of the per-example and the vectorized loss,
+    for batch sizes 32, 128, 512 (flag batch_size is ignored) on random logits
+    """
+    rng = np.random.RandomState(0)
+    P = FLAGS.paragraph_size
+    for B in [32, 128, 512]:
+        lengths = rng.randint(P // 4, P + 1, B)
+        paragraph_masks = np.arange(P)[None, :] < lengths[:, None]
+        starts = (rng.rand(B) * lengths).astype(np.int32)
+        ends = np.minimum(starts + rng.randint(0, 5, B), lengths - 1)
+        logits = rng.randn(2, B, P).astype(np.float32)
+
+        runs = []
+        build_times = []
+        for vectorized in [False, True]:
+            graph = tf.Graph()
+            with graph.as_default():
+                tic = time.time()
+                pred_s = tf.placeholder(tf.float32, (None, None))
+                pred_e = tf.placeholder(tf.float32, (None, None))
+                paragraph_mask = tf.placeholder(tf.bool, (None, None))
+                start_answer = tf.placeholder(tf.int32, (None))
+                end_answer = tf.placeholder(tf.int32, (None))
+                if vectorized:
+                    loss = masked_loss(pred_s, pred_e, paragraph_mask, start_answer, end_answer)
+                else:
+                    loss = unstacked_loss(pred_s, pred_e, paragraph_mask, start_answer, end_answer, B)
+                grads = tf.gradients(loss, [pred_s, pred_e])
+                build_times.append(time.time() - tic)
+
+            feed = {pred_s: logits[0], pred_e: logits[1], paragraph_mask: paragraph_masks, start_answer: starts, end_answer: ends}
+            runs.append((tf.Session(graph=graph), [loss] + grads, feed))
+
+        times = time_runs(runs, FLAGS.steps)
+        for vectorized, build_time, step_time in zip([False, True], build_times, times):
+            logging.info("batch size %d, vectorized=%s: graph build %.1f ms, loss+gradient %.2f ms/batch" % (
+                B, vectorized, 1000 * build_time, 1000 * step_time))
+
+
+BENCHMARKS = {"match_lstm": benchmark_match_lstm, "loss": benchmark_loss}
+
+
+def main(_):
+    logging.info("Benchmark %s with batch size %d, P=%d, Q=%d" % (FLAGS.benchmark, FLAGS.batch_size, FLAGS.paragraph_size, FLAGS.question_size))
+    BENCHMARKS[FLAGS.benchmark]()
+
+if __name__ == "__main__":
+    tf.app.run()
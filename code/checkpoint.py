@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+import logging
+import threading
+
+import tensorflow as tf
+
+
+class CheckpointWriter(object):
+    """
+    Saves checkpoints off the training thread.
+
+    save() copies the variables into shadow variables with one session.run, which is all the
+    training loop waits for, and a background thread writes the shadows to disk under the
+    original variable names, so the files restore with the model's own Saver.
+
+    Keeps the keep newest checkpoints in checkpoint_dir (0 keeps all) and the keep_best highest
+    scoring ones in best_dir, and points each directory's 'checkpoint' file at what it holds.
+    """
+    def __init__(self, variables, checkpoint_dir, best_dir, keep=5, keep_best=1):
+        self.checkpoint_dir = checkpoint_dir
+        self.best_dir = best_dir
+        self.keep = keep
+        self.keep_best = keep_best
+
+        # Outside of any collection, so initializers and other Savers never see them
+        with tf.variable_scope("checkpoint_snapshot"):
+            shadows = [tf.Variable(tf.zeros(v.get_shape(), dtype = v.dtype.base_dtype), trainable = False,
+                                   collections = [], name = v.op.name.replace("/", "_")) for v in variables]
+        self.snapshot_op = tf.group(*[tf.assign(shadow, v) for shadow, v in zip(shadows, variables)])
+        self.saver = tf.train.Saver(dict((v.op.name, shadow) for v, shadow in zip(variables, shadows)), max_to_keep = None)
+
+        self.checkpoints = []   # Paths, oldest first
+        self.best = []          # (score, path), best first
+        self.thread = None
+
+    def save(self, session, step, score=None):
+        """
+        Snapshots the variables and starts writing them as checkpoint step, also as a best
+        checkpoint when score is given and among the keep_best highest so far.
+        Waits for the previous write first, since it still reads the shadow variables.
+        :return: seconds the caller was blocked
+        """
+        tic = time.time()
+        self.wait()
+        session.run(self.snapshot_op)
+        is_best = score is not None and self.keep_best > 0 and \
+            (len(self.best) < self.keep_best or score > self.best[-1][0])
+
+        self.thread = threading.Thread(target = self.write, args = (session, step, score if is_best else None))
+        self.thread.daemon = True
+        self.thread.start()
+        return time.time() - tic
+
+    def wait(self):
+        """
+        Blocks until the last started write is on disk
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def write(self, session, step, best_score):
+        tic = time.time()
+        for directory in [self.checkpoint_dir] + ([self.best_dir] if best_score is not None else []):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+        path = self.saver.save(session, os.path.join(self.checkpoint_dir, "model.ckpt"), step, write_meta_graph = False, write_state = False)
+        self.checkpoints = [p for p in self.checkpoints if p != path] + [path]     # Same step saved again
+        if self.keep > 0:
+            for old_path in self.checkpoints[:-self.keep]:
+                self.delete(old_path)
+            self.checkpoints = self.checkpoints[-self.keep:]
+        tf.train.update_checkpoint_state(self.checkpoint_dir, path, list(self.checkpoints))     # It rewrites the list it gets into relative paths
+
+        if best_score is not None:
+            best_path = self.saver.save(session, os.path.join(self.best_dir, "best_model.ckpt"), step, write_meta_graph = False, write_state = False)
+            self.best = sorted(self.best + [(best_score, best_path)], key = lambda entry: -entry[0])
+            for _, old_path in self.best[self.keep_best:]:
+                self.delete(old_path)
+            self.best = self.best[:self.keep_best]
+            tf.train.update_checkpoint_state(self.best_dir, self.best[0][1], [p for _, p in reversed(self.best)])
+
+        logging.info("Checkpoint %s written in %.2f secs%s" % (path, time.time() - tic,
+                     " (new best: %f)" % best_score if best_score is not None else ""))
+
+    @staticmethod
+    def delete(path):
+        for filename in tf.gfile.Glob(path + ".*"):
+            tf.gfile.Remove(filename)
@@ -0,0 +1,80 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+class Dataset(object):
+    """
+    One tier of examples, stored by column, with every paragraph stored once:
+
+    questions: int32 [N, max_size] token ids, 0 past each length
+    question_lengths: int32 [N]
+    contexts: int32 [C, max_size] token ids of the unique paragraphs, 0 past each length
+    context_lengths: int32 [C]
+    context_ids: int32 [N] paragraph of each example, a row of contexts
+    spans: int32 [N, 2] answer start and end token
+    answer_text, answer_starts, answer_ends: the answer of example i is the whitespace separated
+        bytes answer_text[answer_starts[i]:answer_ends[i]]
+
+    paragraphs and paragraph_lengths give the paragraph of every example, gathered by context id.
+    Masks are built from the lengths when asked for. gather() picks examples by an index array,
+    along with just the contexts they point to; the result shares answer_text with this Dataset.
+    """
+    __slots__ = ["questions", "question_lengths", "contexts", "context_lengths", "context_ids", "spans",
+                 "answer_text", "answer_starts", "answer_ends"]
+
+    def __init__(self, questions, question_lengths, contexts, context_lengths, context_ids, spans,
+                 answer_text, answer_starts, answer_ends):
+        self.questions = questions
+        self.question_lengths = question_lengths
+        self.contexts = contexts
+        self.context_lengths = context_lengths
+        self.context_ids = context_ids
+        self.spans = spans
+        self.answer_text = answer_text
+        self.answer_starts = answer_starts
+        self.answer_ends = answer_ends
+
+    def __len__(self):
+        return len(self.spans)
+
+    @property
+    def paragraphs(self):
+        """
+        int32 [N, max_size] paragraph of each example. A copy: meant for batches, not whole tiers
+        """
+        return self.contexts[self.context_ids]
+
+    @property
+    def paragraph_lengths(self):
+        return self.context_lengths[self.context_ids]
+
+    def gather(self, indices):
+        used_contexts, context_ids = np.unique(self.context_ids[indices], return_inverse = True)
+        return Dataset(self.questions[indices], self.question_lengths[indices], self.contexts[used_contexts],
+                       self.context_lengths[used_contexts], context_ids.astype(np.int32), self.spans[indices],
+                       self.answer_text, self.answer_starts[indices], self.answer_ends[indices])
+
+    def question_mask(self):
+        return mask_from_lengths(self.question_lengths, self.questions.shape[1])
+
+    def paragraph_mask(self):
+        return mask_from_lengths(self.paragraph_lengths, self.contexts.shape[1])
+
+    def answers(self):
+        """
+        :return: list with the answer tokens of each example
+        """
+        return [self.answer_text[start:end].split() for start, end in zip(self.answer_starts, self.answer_ends)]
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.__slots__ if name != "answer_text") + len(self.answer_text)
+
+
+def mask_from_lengths(lengths, width):
+    """
+    :return: bool [len(lengths), width] array, True before each length
+    """
+    return np.arange(width)[None, :] < np.asarray(lengths)[:, None]
@@ -0,0 +1,64 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+def span_scores(B_s, B_e, max_len, lengths=None):
+    """
+    Scores every span with start <= end <= start + max_len as B_s[start] * B_e[end],
+    using a band of max_len + 1 end offsets per start instead of the full P x P outer product.
+
+    :param B_s: [batch, P] start probabilities
+    :param B_e: [batch, P] end probabilities
+    :param max_len: largest allowed end - start
+    :param lengths: paragraph length of each example; ends past it are invalid (default: P)
+    :return: [batch, P, max_len + 1] scores, where [b, i, k] scores the span (i, i + k) and
+             invalid spans score -1
+    """
+    batch, P = B_s.shape
+    if lengths is None:
+        lengths = np.full(batch, P, dtype=np.int64)
+    ends = np.arange(P)[:, None] + np.arange(max_len + 1)[None, :]    # [P, max_len + 1]
+    B_e_padded = np.concatenate([B_e, np.zeros((batch, max_len), dtype=B_e.dtype)], axis = 1)
+
+    scores = B_s[:, :, None] * B_e_padded[:, ends]
+    scores[ends[None, :, :] >= np.asarray(lengths)[:, None, None]] = -1
+    return scores
+
+
+def best_spans(B_s, B_e, max_len, lengths=None):
+    """
+    Finds the highest scoring (start, end) pair with start <= end <= start + max_len
+    for a whole batch at once.
+
+    :return: (a_s, a_e, score) arrays of shape [batch]
+    """
+    scores = span_scores(B_s, B_e, max_len, lengths)
+    flat = scores.reshape(len(scores), -1)
+    best = np.argmax(flat, axis = 1)
+
+    a_s = best // (max_len + 1)
+    a_e = a_s + best % (max_len + 1)
+    return a_s, a_e, flat[np.arange(len(flat)), best]
+
+
+def nbest_spans(B_s, B_e, k, max_len, lengths=None):
+    """
+    Finds the k highest scoring spans of each example, best first.
+    Examples with fewer than k valid spans are filled up with spans scoring -1.
+
+    :return: (a_s, a_e, score) arrays of shape [batch, k]
+    """
+    scores = span_scores(B_s, B_e, max_len, lengths)
+    flat = scores.reshape(len(scores), -1)
+    k = min(k, flat.shape[1])
+
+    rows = np.arange(len(flat))[:, None]
+    top = np.argpartition(-flat, k - 1, axis = 1)[:, :k]
+    top = top[rows, np.argsort(-flat[rows, top], axis = 1)]
+
+    a_s = top // (max_len + 1)
+    a_e = a_s + top % (max_len + 1)
+    return a_s, a_e, flat[rows, top]
@@ -6,6 +6,9 @@ import re
 import argparse
 import json
 import sys
+from multiprocessing import Pool
+
+import six
 
 
 def normalize_answer(s):
@@ -75,12 +78,148 @@ def evaluate(dataset, predictions):
     return {'exact_match': exact_match, 'f1': f1}
 
 
+ARTICLES = re.compile(r'\b(a|an|the)\b')
+PUNCTUATION_TABLE = dict((ord(ch), None) for ch in string.punctuation)
+
+
+def fast_normalize_answer(s):
+    """normalize_answer with a precompiled regex and translate() for the punctuation.
+    Same result for unicode and byte strings."""
+    s = s.lower()
+    if isinstance(s, six.text_type):
+        s = s.translate(PUNCTUATION_TABLE)
+    else:
+        s = s.translate(None, string.punctuation)
+    return ' '.join(ARTICLES.sub(' ', s).split())
+
+
+def score_prediction(prediction, ground_truths):
+    """(exact match, f1) of one prediction against pre-normalized ground truths, given as
+    (normalized text, token Counter, token count) tuples. Same arithmetic as f1_score and
+    exact_match_score, so the numbers are identical."""
+    normalized = fast_normalize_answer(prediction)
+    prediction_tokens = normalized.split()
+    prediction_counts = Counter(prediction_tokens)
+    prediction_length = len(prediction_tokens)
+
+    exact_match = f1 = 0
+    for ground_truth, ground_truth_counts, ground_truth_length in ground_truths:
+        exact_match = max(exact_match, normalized == ground_truth)
+        # Size of the Counter intersection, without building it
+        num_same = sum(min(count, ground_truth_counts[token]) for token, count in prediction_counts.items() if token in ground_truth_counts)
+        if num_same == 0:
+            continue
+        precision = 1.0 * num_same / prediction_length
+        recall = 1.0 * num_same / ground_truth_length
+        f1 = max(f1, (2 * precision * recall) / (precision + recall))
+    return exact_match, f1
+
+
+_worker_ground_truths = None
+
+
+def _init_score_worker(ground_truths):
+    global _worker_ground_truths
+    _worker_ground_truths = ground_truths
+
+
+def _score_chunk(chunk):
+    return [score_prediction(prediction, _worker_ground_truths[i]) for i, prediction in chunk]
+
+
+class FastEvaluator(object):
+    """
+    Scores many predictions against a fixed set of questions. Every ground truth is normalized
+    and counted once, when the evaluator is built, instead of for every comparison. Gives
+    exactly the numbers of evaluate(), and can spread the scoring over a process pool.
+
+    :param ground_truths: one list of answer strings per question
+    :param workers: processes to score with (1: score in this process)
+    """
+    def __init__(self, ground_truths, workers=1):
+        self.ground_truths = []
+        for answers in ground_truths:
+            normalized = [fast_normalize_answer(answer) for answer in answers]
+            self.ground_truths.append([(answer, Counter(answer.split()), len(answer.split())) for answer in normalized])
+        self.workers = workers
+
+    @classmethod
+    def from_squad(cls, dataset, workers=1):
+        """
+        :return: evaluator and the question ids, in the order of the SQuAD JSON 'data'
+        """
+        ids, ground_truths = [], []
+        for article in dataset:
+            for paragraph in article['paragraphs']:
+                for qa in paragraph['qas']:
+                    ids.append(qa['id'])
+                    ground_truths.append([answer['text'] for answer in qa['answers']])
+        return cls(ground_truths, workers), ids
+
+    def score(self, predictions, indices=None):
+        """
+        :param predictions: answer strings, None for unanswered questions (they score 0)
+        :param indices: question of each prediction (default: predictions are for every question, in order)
+        :return: (exact_match, f1) in percent
+        """
+        if indices is None:
+            indices = range(len(predictions))
+        answered = [(i, prediction) for i, prediction in zip(indices, predictions) if prediction is not None]
+
+        if self.workers > 1 and len(answered) > self.workers:
+            chunk_size = -(-len(answered) // (4 * self.workers))
+            chunks = [answered[start : start + chunk_size] for start in range(0, len(answered), chunk_size)]
+            pool = Pool(self.workers, initializer=_init_score_worker, initargs=(self.ground_truths,))
+            try:
+                scores = [score for chunk in pool.map(_score_chunk, chunks) for score in chunk]
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            scores = [score_prediction(prediction, self.ground_truths[i]) for i, prediction in answered]
+
+        # Summed in question order, like evaluate(), so the floats come out the same
+        exact_match = f1 = 0
+        for question_exact_match, question_f1 in scores:
+            exact_match += question_exact_match
+            f1 += question_f1
+        total = max(len(predictions), 1)
+        return 100.0 * exact_match / total, 100.0 * f1 / total
+
+
+def fast_evaluate(dataset, predictions, workers=1):
+    """evaluate() through a FastEvaluator"""
+    evaluator, ids = FastEvaluator.from_squad(dataset, workers)
+    for question_id in ids:
+        if question_id not in predictions:
+            message = 'Unanswered question ' + question_id + \
+                      ' will receive score 0.'
+            print(message, file=sys.stderr)
+    exact_match, f1 = evaluator.score([predictions.get(question_id) for question_id in ids])
+    return {'exact_match': exact_match, 'f1': f1}
+
+
+def load_predictions(prediction_file):
+    """Predictions of a JSON {id: answer} file, or of a .jsonl file with one
+    {"id", "answer"} object per line (qa_answer.py --stream)"""
+    with open(prediction_file) as f:
+        if not prediction_file.endswith('.jsonl'):
+            return json.load(f)
+        predictions = {}
+        for line in f:
+            if line.strip():
+                prediction = json.loads(line)
+                predictions[prediction['id']] = prediction['answer']
+        return predictions
+
+
 if __name__ == '__main__':
     expected_version = '1.1'
     parser = argparse.ArgumentParser(
         description='Evaluation for SQuAD ' + expected_version)
     parser.add_argument('dataset_file', help='Dataset file')
-    parser.add_argument('prediction_file', help='Prediction File')
+    parser.add_argument('prediction_file', help='Prediction File (JSON, or JSONL of id and answer)')
+    parser.add_argument('--workers', type=int, default=1, help='Processes to score with')
     args = parser.parse_args()
     with open(args.dataset_file) as dataset_file:
         dataset_json = json.load(dataset_file)
@@ -89,6 +228,5 @@ if __name__ == '__main__':
                   ', but got dataset with v-' + dataset_json['version'],
                   file=sys.stderr)
         dataset = dataset_json['data']
-    with open(args.prediction_file) as prediction_file:
-        predictions = json.load(prediction_file)
-    print(json.dumps(evaluate(dataset, predictions)))
+    predictions = load_predictions(args.prediction_file)
+    print(json.dumps(fast_evaluate(dataset, predictions, args.workers)))
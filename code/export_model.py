@@ -0,0 +1,78 @@
+"""
+Writes a trained checkpoint as a frozen inference graph for qa_answer.py --frozen_graph:
+
+    python code/export_model.py --train_dir=train/match-lstm/<run> --frozen_graph=train/frozen_model.pb
+
+The weights and the GloVe embeddings become constants, and everything the Beta_s/Beta_e outputs
+do not need (loss, optimizer, gradient clipping, Adam slots, summaries) is pruned.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import logging
+from os.path import join as pjoin
+
+import tensorflow as tf
+
+from qa_model import Encoder, QASystem, Decoder, FrozenQASystem
+
+logging.basicConfig(level=logging.INFO)
+
+tf.app.flags.DEFINE_float("learning_rate", 0.001, "Learning rate.")
+tf.app.flags.DEFINE_float("max_gradient_norm", 10.0, "Clip gradients to this norm.")
+tf.app.flags.DEFINE_integer("state_size", 150, "Size of each model layer. MUST be the same as the model.")
+tf.app.flags.DEFINE_integer("embedding_size", 300, "Size of the pretrained vocabulary. MUST be the same as the model.")
+tf.app.flags.DEFINE_integer("max_paragraph_size", 300, "The length to cut paragraphs off at. MUST be the same as the model.")
+tf.app.flags.DEFINE_integer("max_question_size", 20, "The length to cut question off at. MUST be the same as the model.")
+tf.app.flags.DEFINE_integer("max_answer_length", 15, "Longest answer span (end - start) to consider when decoding.")
+tf.app.flags.DEFINE_string("optimizer", "adam", "adam / sgd")
+tf.app.flags.DEFINE_string("train_dir", "train", "Training directory to read the checkpoint from (default: ./train).")
+tf.app.flags.DEFINE_string("embed_path", "", "Path to the trimmed GLoVe embedding (default: ./data/squad/glove.trimmed.{embedding_size}.npz)")
+tf.app.flags.DEFINE_string("frozen_graph", "train/frozen_model.pb", "Where to write the frozen graph (default: ./train/frozen_model.pb)")
+tf.app.flags.DEFINE_bool("fast_match_lstm", True, "Project the paragraph for the Match-LSTM once outside the recurrence (same weights and outputs).")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def export_frozen_graph(session, path):
+    """
+    Folds the current variable values of the default graph into constants and writes the part
+    of the graph that computes FrozenQASystem.OUTPUT_NAMES to path
+    :return: the number of nodes written
+    """
+    graph_def = tf.get_default_graph().as_graph_def()
+    frozen = tf.graph_util.convert_variables_to_constants(session, graph_def, FrozenQASystem.OUTPUT_NAMES)
+
+    with tf.gfile.GFile(path, "wb") as f:
+        f.write(frozen.SerializeToString())
+    return len(frozen.node)
+
+
+def main(_):
+    FLAGS.embed_path = FLAGS.embed_path or pjoin("data", "squad", "glove.trimmed.{}.npz".format(FLAGS.embedding_size))
+
+    encoder = Encoder(size=FLAGS.state_size, vocab_dim=FLAGS.embedding_size, FLAGS=FLAGS)
+    decoder = Decoder(FLAGS=FLAGS)
+    qa = QASystem(encoder, decoder, FLAGS)
+
+    ckpt = tf.train.get_checkpoint_state(FLAGS.train_dir)
+    if not ckpt:
+        raise ValueError("No checkpoint found in %s" % FLAGS.train_dir)
+
+    with tf.Session() as sess:
+        logging.info("Reading model parameters from %s" % ckpt.model_checkpoint_path)
+        qa.saver.restore(sess, ckpt.model_checkpoint_path)
+        qa.initialize_embeddings(sess)
+
+        output_dir = os.path.dirname(FLAGS.frozen_graph)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        num_nodes = export_frozen_graph(sess, FLAGS.frozen_graph)
+        logging.info("Wrote %d of %d graph nodes to %s (%d bytes)" % (num_nodes, len(sess.graph.as_graph_def().node),
+                                                                     FLAGS.frozen_graph, os.path.getsize(FLAGS.frozen_graph)))
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+from collections import OrderedDict
+
+
+class ParagraphCache(object):
+    """
+    Least recently used cache of paragraph encodings (HP, [length, state_size] arrays), keyed
+    by a hash of the paragraph's token ids, holding at most capacity paragraphs.
+
+    Also counts, for a report, how many questions were answered and how many paragraphs
+    (and tokens) actually had to be encoded for them.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.questions = 0
+        self.tokens = 0
+        self.encoded = 0
+        self.encoded_tokens = 0
+
+    @staticmethod
+    def key(paragraph):
+        """
+        :param paragraph: int32 array of the paragraph's token ids, without padding
+        """
+        return hashlib.sha1(paragraph.tobytes()).digest()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        encoding = self.entries.pop(key)
+        self.entries[key] = encoding
+        return encoding
+
+    def put(self, key, encoding):
+        self.entries.pop(key, None)
+        self.entries[key] = encoding
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last = False)
+
+    def add(self, lengths, encoded_lengths):
+        """
+        Counts one batch: the paragraph lengths of its questions and of the paragraphs encoded for it
+        """
+        self.questions += len(lengths)
+        self.tokens += int(sum(lengths))
+        self.encoded += len(encoded_lengths)
+        self.encoded_tokens += int(sum(encoded_lengths))
+
+    def summary(self):
+        return "Paragraph cache: %d questions, %d paragraph encodings (hit rate %.1f%%), %d of %d paragraph tokens encoded (%.1f%% of the paragraph LSTM saved)" % (
+            self.questions, self.encoded, 100.0 * (self.questions - self.encoded) / max(self.questions, 1),
+            self.encoded_tokens, self.tokens, 100.0 * (self.tokens - self.encoded_tokens) / max(self.tokens, 1))
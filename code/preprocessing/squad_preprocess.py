@@ -1,15 +1,16 @@
 from __future__ import print_function
 import argparse
 import json
-import linecache
 import nltk
 import numpy as np
 import os
+import shutil
 import sys
 from tqdm import tqdm
 import random
 
 from collections import Counter
+from multiprocessing import Pool, cpu_count
 from six.moves.urllib.request import urlretrieve
 
 reload(sys)
@@ -81,20 +82,27 @@ def tokenize(sequence):
     return map(lambda x:x.encode('utf8'), tokens)
 
 
+def token_char_offsets(context, context_tokens):
+    """Aligns the tokens with the context in one linear pass. Returns the
+    (char_start, char_end) of each token, stopping at the first token that
+    does not follow the previous one (after skipping spaces)."""
+    offsets = []
+    char_idx = 0
+    for token in context_tokens:
+        token = unicode(token)
+        while char_idx < len(context) and context[char_idx] == u' ':
+            char_idx += 1
+        if not context.startswith(token, char_idx):
+            break
+        offsets.append((char_idx, char_idx + len(token)))
+        char_idx += len(token)
+    return offsets
+
+
 def token_idx_map(context, context_tokens):
-    acc = ''
-    current_token_idx = 0
     token_map = dict()
-
-    for char_idx, char in enumerate(context):
-        if char != u' ':
-            acc += char
-            context_token = unicode(context_tokens[current_token_idx])
-            if acc == context_token:
-                syn_start = char_idx - len(acc) + 1
-                token_map[syn_start] = [acc, current_token_idx]
-                acc = ''
-                current_token_idx += 1
+    for current_token_idx, (syn_start, syn_end) in enumerate(token_char_offsets(context, context_tokens)):
+        token_map[syn_start] = [context[syn_start:syn_end], current_token_idx]
     return token_map
 
 
@@ -102,20 +110,31 @@ def invert_map(answer_map):
     return {v[1]: [v[0], k] for k, v in answer_map.iteritems()}
 
 
-def read_write_dataset(dataset, tier, prefix):
-    """Reads the dataset, extracts context, question, answer,
-    and answer pointer in their own file. Returns the number
-    of questions and answers processed for the dataset"""
+CONTEXT_FILES = ['context', 'context.offsets']
+QUESTION_FILES = ['question', 'answer', 'span']
+DATA_FILES = CONTEXT_FILES + QUESTION_FILES + ['context_id']
+
+
+def write_shard(job):
+    """Tokenizes a contiguous slice of articles and writes its context and context
+    token char offsets lines, once per paragraph, and its question, answer, answer
+    pointer and context_id lines, once per question, to {shard_prefix}.context etc.
+    context_id is the line of the question's paragraph in the shard's context file.
+    Returns the number of questions, answers, skipped answers and contexts in the shard"""
+    articles, shard_prefix = job
     qn, an = 0, 0
     skipped = 0
+    num_contexts = 0
 
-    with open(os.path.join(prefix, tier +'.context'), 'w') as context_file,  \
-         open(os.path.join(prefix, tier +'.question'), 'w') as question_file,\
-         open(os.path.join(prefix, tier +'.answer'), 'w') as text_file, \
-         open(os.path.join(prefix, tier +'.span'), 'w') as span_file:
+    with open(shard_prefix + '.context', 'w') as context_file,  \
+         open(shard_prefix + '.context.offsets', 'w') as offsets_file,  \
+         open(shard_prefix + '.question', 'w') as question_file,\
+         open(shard_prefix + '.answer', 'w') as text_file, \
+         open(shard_prefix + '.span', 'w') as span_file, \
+         open(shard_prefix + '.context_id', 'w') as context_id_file:
 
-        for articles_id in tqdm(range(len(dataset['data'])), desc="Preprocessing {}".format(tier)):
-            article_paragraphs = dataset['data'][articles_id]['paragraphs']
+        for article in articles:
+            article_paragraphs = article['paragraphs']
             for pid in range(len(article_paragraphs)):
                 context = article_paragraphs[pid]['context']
                 # The following replacements are suggested in the paper
@@ -123,8 +142,13 @@ def read_write_dataset(dataset, tier, prefix):
                 context = context.replace("''", '" ')
                 context = context.replace("``", '" ')
 
+                # Tokenize each paragraph once, and join it once for all of its questions
                 context_tokens = tokenize(context)
-                answer_map = token_idx_map(context, context_tokens)
+                context_line = ' '.join(context_tokens) + '\n'
+                context_offsets = token_char_offsets(context, context_tokens)
+                offsets_line = ' '.join('{} {}'.format(start, end) for start, end in context_offsets) + '\n'
+                answer_map = dict((start, [context[start:end], token_idx]) for token_idx, (start, end) in enumerate(context_offsets))
+                context_id = None   # Written with the paragraph's first kept question
 
                 qas = article_paragraphs[pid]['qas']
                 for qid in range(len(qas)):
@@ -155,7 +179,12 @@ def read_write_dataset(dataset, tier, prefix):
                             a_end_idx = answer_map[answer_end - last_word_answer][1]
 
                             # remove length restraint since we deal with it later
-                            context_file.write(' '.join(context_tokens) + '\n')
+                            if context_id is None:
+                                context_id = num_contexts
+                                num_contexts += 1
+                                context_file.write(context_line)
+                                offsets_file.write(offsets_line)
+                            context_id_file.write(str(context_id) + '\n')
                             question_file.write(' '.join(question_tokens) + '\n')
                             text_file.write(' '.join(text_tokens) + '\n')
                             span_file.write(' '.join([str(a_start_idx), str(a_end_idx)]) + '\n')
@@ -165,43 +194,118 @@ def read_write_dataset(dataset, tier, prefix):
 
                         an += 1
 
+    return qn, an, skipped, num_contexts
+
+
+def read_write_dataset(dataset, tier, prefix, workers=1):
+    """Reads the dataset, extracts context, question, answer,
+    and answer pointer in their own file. Contexts are written once, and
+    questions point to theirs through the context_id file. Returns the number
+    of questions and answers processed for the dataset.
+
+    Articles are split into contiguous shards that a pool of workers
+    tokenizes into their own files; the shards are then concatenated
+    in article order, so the output does not depend on workers."""
+    articles = dataset['data']
+    num_shards = min(len(articles), 4 * workers)
+    bounds = [len(articles) * i // max(num_shards, 1) for i in range(num_shards + 1)]
+    shard_prefixes = [os.path.join(prefix, '{}.shard{}'.format(tier, i)) for i in range(num_shards)]
+    jobs = [(articles[bounds[i]:bounds[i + 1]], shard_prefixes[i]) for i in range(num_shards)]
+
+    if workers > 1:
+        pool = Pool(workers)
+        try:
+            counts = list(tqdm(pool.imap(write_shard, jobs), total=num_shards, desc="Preprocessing {}".format(tier)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        counts = [write_shard(job) for job in tqdm(jobs, desc="Preprocessing {}".format(tier))]
+
+    # Context ids restart at 0 in every shard, so shift them past the contexts of earlier shards
+    context_id_shifts = np.cumsum([0] + [shard_counts[3] for shard_counts in counts])
+    for data_file in DATA_FILES:
+        with open(os.path.join(prefix, tier + '.' + data_file), 'w') as merged_file:
+            for shard_prefix, shift in zip(shard_prefixes, context_id_shifts):
+                with open(shard_prefix + '.' + data_file) as shard_file:
+                    if data_file == 'context_id':
+                        merged_file.writelines('{}\n'.format(int(line) + shift) for line in shard_file)
+                    else:
+                        shutil.copyfileobj(shard_file, merged_file)
+                os.remove(shard_prefix + '.' + data_file)
+
+    # Summed per field from zeros, so a dataset without articles gives 0 too
+    qn, an, skipped, num_contexts = [sum(shard_counts[field] for shard_counts in counts) for field in range(4)]
     print("Skipped {} question/answer pairs in {}".format(skipped, tier))
+    print("{} questions share {} unique contexts in {}".format(qn - skipped, num_contexts, tier))
     return qn,an
 
 
-def save_files(prefix, tier, indices):
-  with open(os.path.join(prefix, tier + '.context'), 'w') as context_file,  \
-     open(os.path.join(prefix, tier + '.question'), 'w') as question_file,\
-     open(os.path.join(prefix, tier + '.answer'), 'w') as text_file, \
-     open(os.path.join(prefix, tier + '.span'), 'w') as span_file:
-
-    for i in indices:
-      context_file.write(linecache.getline(os.path.join(prefix, 'train.context'), i))
-      question_file.write(linecache.getline(os.path.join(prefix, 'train.question'), i))
-      text_file.write(linecache.getline(os.path.join(prefix, 'train.answer'), i))
-      span_file.write(linecache.getline(os.path.join(prefix, 'train.span'), i))
+def line_offsets(filename, block_size=1 << 24):
+  """Byte offset of the start of every line of filename, found in one
+  streaming pass that holds a single block in memory at a time"""
+  offsets = [np.zeros(1, dtype=np.int64)]
+  position = 0
+  with open(filename, 'rb') as f:
+    for block in iter(lambda: f.read(block_size), b''):
+      newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+      offsets.append(newlines.astype(np.int64) + position + 1)
+      position += len(block)
+  offsets = np.concatenate(offsets)
+  return offsets[offsets < position]   # Drop the offset past the final newline
+
+
+def save_files(prefix, tier, indices, data_files, source_tier='train'):
+  """Writes lines indices of the {source_tier} data_files to {tier}, seeking to
+  each line through a line offset index instead of reading whole files. Outputs
+  go to .tmp files, since source_tier and tier may be the same files"""
+  for data_file in data_files:
+    source_filename = os.path.join(prefix, source_tier + '.' + data_file)
+    offsets = line_offsets(source_filename)
+    with open(source_filename, 'rb') as source_file, \
+         open(os.path.join(prefix, tier + '.' + data_file + '.tmp'), 'wb') as target_file:
+      for i in indices:
+        source_file.seek(offsets[i])
+        target_file.write(source_file.readline())
+
+
+def save_tier(prefix, tier, indices, source_tier='train'):
+  """Writes questions indices of {source_tier} to {tier}, with only the contexts
+  they point to, in their original order, and context ids renumbered to match"""
+  context_ids = np.fromfile(os.path.join(prefix, source_tier + '.context_id'), dtype=np.int64, sep=' ')
+  used_contexts, tier_context_ids = np.unique(context_ids[indices], return_inverse=True)
+  save_files(prefix, tier, indices, QUESTION_FILES, source_tier)
+  save_files(prefix, tier, used_contexts, CONTEXT_FILES, source_tier)
+  with open(os.path.join(prefix, tier + '.context_id.tmp'), 'w') as context_id_file:
+    context_id_file.writelines('{}\n'.format(context_id) for context_id in tier_context_ids)
 
 
 def split_tier(prefix, train_percentage = 0.9, shuffle=False):
-    # Get number of lines in file
-    context_filename = os.path.join(prefix, 'train' + '.context')
-    # Get the number of lines
-    with open(context_filename) as current_file:
-        num_lines = sum(1 for line in current_file)
+    # Get the number of questions
+    num_lines = len(line_offsets(os.path.join(prefix, 'train' + '.question')))
     # Get indices and split into two files
-    indices_dev = range(num_lines)[int(num_lines * train_percentage)::]
+    indices_dev = np.arange(num_lines)[int(num_lines * train_percentage)::]
     if shuffle:
         np.random.shuffle(indices_dev)
         print("Shuffling...")
-    save_files(prefix, 'val', indices_dev)
-    indices_train = range(num_lines)[:int(num_lines * train_percentage)]
+    save_tier(prefix, 'val', indices_dev)
+    indices_train = np.arange(num_lines)[:int(num_lines * train_percentage)]
     if shuffle:
         np.random.shuffle(indices_train)
-    save_files(prefix, 'train', indices_train)
+    save_tier(prefix, 'train', indices_train)
+
+    for tier in ['val', 'train']:
+        for data_file in DATA_FILES:
+            filename = os.path.join(prefix, tier + '.' + data_file)
+            os.rename(filename + '.tmp', filename)
 
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default=cpu_count(), type=int, help="Processes used to tokenize the dataset")
+    args = parser.parse_args()
+
     download_prefix = os.path.join("download", "squad")
     data_prefix = os.path.join("data", "squad")
 
@@ -220,7 +324,7 @@ if __name__ == '__main__':
 
     train_data = data_from_json(os.path.join(download_prefix, train_filename))
 
-    train_num_questions, train_num_answers = read_write_dataset(train_data, 'train', data_prefix)
+    train_num_questions, train_num_answers = read_write_dataset(train_data, 'train', data_prefix, args.workers)
 
     # In train we have 87k+ questions, and one answer per question.
     # The answer start range is also indicated
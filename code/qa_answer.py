@@ -5,28 +5,28 @@ from __future__ import print_function
 import io
 import os
 import json
-import sys
-import random
+import time
 from os.path import join as pjoin
 
 from tqdm import tqdm
 import numpy as np
-from six.moves import xrange
 import tensorflow as tf
 
-from qa_model import Encoder, QASystem, Decoder
+from qa_model import Encoder, QASystem, Decoder, FrozenQASystem
 from preprocessing.squad_preprocess import data_from_json, maybe_download, squad_base_url, \
-    invert_map, tokenize, token_idx_map
+    tokenize, token_char_offsets
 import qa_data
-from utils import get_dataset, initialize_model, initialize_vocab, get_normalized_train_dir
+from paragraph_cache import ParagraphCache
+from utils import initialize_model, initialize_vocab, pad_inputs
 
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
 tf.app.flags.DEFINE_float("learning_rate", 0.001, "Learning rate.")
+tf.app.flags.DEFINE_float("max_gradient_norm", 10.0, "Clip gradients to this norm.")
 tf.app.flags.DEFINE_float("dropout", 0.15, "Fraction of units randomly dropped on non-recurrent connections.")
-tf.app.flags.DEFINE_integer("batch_size", 10, "Batch size to use during training.")
+tf.app.flags.DEFINE_integer("batch_size", 100, "Batch size to use when answering.")
 tf.app.flags.DEFINE_integer("epochs", 0, "Number of epochs to train.")
 tf.app.flags.DEFINE_integer("state_size", 150, "Size of each model layer.")
 tf.app.flags.DEFINE_integer("embedding_size", 100, "Size of the pretrained vocabulary.")
@@ -34,14 +34,70 @@ tf.app.flags.DEFINE_integer("output_size", 750, "The output size of your model."
 tf.app.flags.DEFINE_integer("keep", 0, "How many checkpoints to keep, 0 indicates keep all.")
 tf.app.flags.DEFINE_string("train_dir", "train", "Training directory (default: ./train).")
 tf.app.flags.DEFINE_string("log_dir", "log", "Path to store log and flag files (default: ./log)")
+tf.app.flags.DEFINE_string("optimizer", "adam", "adam / sgd")
 tf.app.flags.DEFINE_string("vocab_path", "data/squad/vocab.dat", "Path to vocab file (default: ./data/squad/vocab.dat)")
 tf.app.flags.DEFINE_string("embed_path", "", "Path to the trimmed GLoVe embedding (default: ./data/squad/glove.trimmed.{embedding_size}.npz)")
+tf.app.flags.DEFINE_string("glove_path", "", "GloVe text file whose binary GloveStore gives vectors to dev words outside the vocab (default: off, they map to <unk>)")
+tf.app.flags.DEFINE_bool("fast_match_lstm", True, "Project the paragraph for the Match-LSTM once outside the recurrence (same weights and outputs).")
+tf.app.flags.DEFINE_integer("paragraph_cache", 100, "Paragraph encodings to keep in an LRU cache, so questions on the same paragraph reuse them (0 disables).")
+tf.app.flags.DEFINE_string("frozen_graph", "", "Frozen graph written by export_model.py to answer with instead of building the model and restoring train_dir (default: off)")
 tf.app.flags.DEFINE_string("dev_path", "data/squad/dev-v1.1.json", "Path to the JSON dev set to evaluate against (default: ./data/squad/dev-v1.1.json)")
+tf.app.flags.DEFINE_bool("stream", False, "Read the questions of dev_path (SQuAD JSON, or .jsonl lines of id, context and question) one batch at a time and append each batch's answers to stream_output, skipping ids it already holds.")
+tf.app.flags.DEFINE_string("stream_output", "dev-prediction.jsonl", "JSONL file --stream appends {id, answer} lines to (default: ./dev-prediction.jsonl)")
 tf.app.flags.DEFINE_integer("max_paragraph_size", 300, "The length to cut paragraphs off at. MUST be the same as the model.")   # As per Frank's histogram.
 tf.app.flags.DEFINE_integer("max_question_size", 20, "The length to cut question off at. MUST be the same as the model.")   # As per Frank's histogram
+tf.app.flags.DEFINE_integer("max_answer_length", 15, "Longest answer span (end - start) to consider when decoding.")
 
 FLAGS = tf.app.flags.FLAGS
 
+class GloveBackedVocab(object):
+    """
+    Vocab lookups that give words missing from the training vocab new ids after it, when the
+    GloVe store has a vector for them, instead of UNK_ID. rev_vocab is extended in place.
+    """
+    def __init__(self, vocab, rev_vocab, glove_store):
+        self.vocab = vocab
+        self.rev_vocab = rev_vocab
+        self.glove_store = glove_store
+        self.extra_vectors = []
+
+    def get(self, word, default=None):
+        if word not in self.vocab:
+            vector = self.glove_store.lookup(word)
+            if vector is None:
+                return default
+            self.vocab[word] = len(self.rev_vocab)
+            self.rev_vocab.append(word)
+            self.extra_vectors.append(vector)
+        return self.vocab[word]
+
+def tokenize_context(raw_context):
+    """
+    Tokens of a paragraph and the (char_start, char_end) in raw_context of each
+    """
+    # The following replacements are suggested in the paper
+    # BidAF (Seo et al., 2016)
+    context = raw_context.replace("''", '" ')
+    context = context.replace("``", '" ')
+
+    context_tokens = tokenize(context)
+    # The replacements keep char positions, so the offsets also index into raw_context
+    return context_tokens, token_char_offsets(context, context_tokens)
+
+
+def span_text(paragraph, span, context_text, context_offsets, rev_vocab):
+    """
+    The answer text of a predicted (a_s, a_e) token span of paragraph (token ids)
+    """
+    a_s, a_e = span
+    if a_e < len(context_offsets):
+        # Slice the original paragraph by char range, which keeps its spacing and words outside the vocab
+        return context_text[context_offsets[a_s][0] : context_offsets[a_e][1]]
+
+    token_answer = paragraph[a_s : a_e + 1]      #The slice of the context paragraph that is our answer
+    return ' '.join(rev_vocab[token] for token in token_answer)
+
+
 def read_dataset(dataset, tier, vocab):
     """Reads the dataset, extracts context, question, answer,
     and answer pointer in their own file. Returns the number
@@ -50,17 +106,16 @@ def read_dataset(dataset, tier, vocab):
     context_data = []
     query_data = []
     question_uuid_data = []
+    context_text_data = []
+    context_offsets_data = []
 
     for articles_id in tqdm(range(len(dataset['data'])), desc="Preprocessing {}".format(tier)):
         article_paragraphs = dataset['data'][articles_id]['paragraphs']
         for pid in range(len(article_paragraphs)):
-            context = article_paragraphs[pid]['context']
-            # The following replacements are suggested in the paper
-            # BidAF (Seo et al., 2016)
-            context = context.replace("''", '" ')
-            context = context.replace("``", '" ')
-
-            context_tokens = tokenize(context)
+            raw_context = article_paragraphs[pid]['context']
+            context_tokens, context_offsets = tokenize_context(raw_context)
+            # Shared by all questions of the paragraph
+            context_ids = ' '.join(str(vocab.get(w, qa_data.UNK_ID)) for w in context_tokens)
 
             qas = article_paragraphs[pid]['qas']
             for qid in range(len(qas)):
@@ -68,14 +123,15 @@ def read_dataset(dataset, tier, vocab):
                 question_tokens = tokenize(question)
                 question_uuid = qas[qid]['id']
 
-                context_ids = [str(vocab.get(w, qa_data.UNK_ID)) for w in context_tokens]
                 qustion_ids = [str(vocab.get(w, qa_data.UNK_ID)) for w in question_tokens]
 
-                context_data.append(' '.join(context_ids))
+                context_data.append(context_ids)
                 query_data.append(' '.join(qustion_ids))
                 question_uuid_data.append(question_uuid)
+                context_text_data.append(raw_context)
+                context_offsets_data.append(context_offsets)
 
-    return context_data, query_data, question_uuid_data
+    return context_data, query_data, question_uuid_data, context_text_data, context_offsets_data
 
 
 def prepare_dev(prefix, dev_filename, vocab):
@@ -83,9 +139,18 @@ def prepare_dev(prefix, dev_filename, vocab):
     dev_dataset = maybe_download(squad_base_url, dev_filename, prefix)
 
     dev_data = data_from_json(os.path.join(prefix, dev_filename))
-    context_data, question_data, question_uuid_data = read_dataset(dev_data, 'dev', vocab)
+    return read_dataset(dev_data, 'dev', vocab)
+
 
-    return context_data, question_data, question_uuid_data
+def first_example(dataset):
+    """
+    The (question, paragraph, question mask, paragraph mask) of the first dev example
+    """
+    question = [int(word) for word in dataset["val_questions"][0].split()]
+    context = [int(word) for word in dataset["val_context"][0].split()]
+    (question,), (question_mask,) = pad_inputs([question], FLAGS.max_question_size)
+    (context,), (context_mask,) = pad_inputs([context], FLAGS.max_paragraph_size)
+    return question, context, question_mask, context_mask
 
 
 def generate_answers(sess, model, dataset, rev_vocab):
@@ -107,26 +172,169 @@ def generate_answers(sess, model, dataset, rev_vocab):
     :param rev_vocab: this is a list of vocabulary that maps index to actual words
     :return:
     """
-    questions_padded, questions_masked = pad_inputs(dataset["val_questions"], max_length)
-    context_padded, context_masked = pad_inputs(dataset["val_context"], max_length)
-
-    unified_dataset = zip(questions_padded, questions_masked, context_padded, context_masked, dataset["val_question_uuids"])
+    questions = [[int(word) for word in question.split()] for question in dataset["val_questions"]]
+    parsed_contexts = {}    # Questions of one paragraph share its id string, so parse each once
+    contexts = []
+    for context in dataset["val_context"]:
+        if context not in parsed_contexts:
+            parsed_contexts[context] = [int(word) for word in context.split()]
+        contexts.append(parsed_contexts[context])
+    questions_padded, questions_masked = pad_inputs(questions, FLAGS.max_question_size)
+    context_padded, context_masked = pad_inputs(contexts, FLAGS.max_paragraph_size)
+
+    tic = time.time()
+    paragraph_cache = ParagraphCache(FLAGS.paragraph_cache) if FLAGS.paragraph_cache > 0 else None
+    spans = model.answer_batch(sess, questions_padded, context_padded, questions_masked, context_masked, batch_size=FLAGS.batch_size,
+                               paragraph_cache=paragraph_cache)
+    logging.info("Answered %d questions in %.2f secs" % (len(spans), time.time() - tic))
+    if paragraph_cache is not None:
+        logging.info(paragraph_cache.summary())
 
     answers = {}
 
-    for question, question_mask, paragraph, paragraph_mask, uuid in unified_dataset:
-        a_s, a_e = model.answer(sess, question, paragraph, question_mask, paragraph_mask)
-        token_answer = paragraph[a_s : a_e + 1]      #The slice of the context paragraph that is our answer
-        sentence = []
-        for token in token_answer:
-            word = rev_vocab[token]
-            sentence.append(word)
-        answer = ' '.join(word for word in sentence)
-        answers[uuid] = answer
+    for paragraph, span, uuid, context_text, context_offsets in zip(context_padded, spans, dataset["val_question_uuids"],
+                                                                    dataset["val_context_text"], dataset["val_context_offsets"]):
+        answers[uuid] = span_text(paragraph, span, context_text, context_offsets, rev_vocab)
 
     return answers
 
 
+def read_questions(path):
+    """
+    Yields (uuid, context, question) of every question of a SQuAD JSON file or of a JSONL file
+    with one {"id", "context", "question"} object per line. JSONL is read a line at a time;
+    a SQuAD file is parsed whole, but nothing is derived from it ahead of time.
+    """
+    if path.endswith(".jsonl"):
+        with io.open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    question = json.loads(line)
+                    yield question['id'], question['context'], question['question']
+        return
+
+    for article in data_from_json(path)['data']:
+        for paragraph in article['paragraphs']:
+            for qa in paragraph['qas']:
+                yield qa['id'], paragraph['context'], qa['question']
+
+
+def read_written_ids(path):
+    """
+    The uuids already answered in the JSONL predictions file path. A last line cut off by an
+    interrupted run (no newline yet) is truncated away, so it is answered (and written whole)
+    again. Any other line that is not an {"id", "answer"} object raises a ValueError.
+    """
+    written = set()
+    if not os.path.exists(path):
+        return written
+
+    complete = 0    # Bytes up to the end of the last whole line
+    with open(path, 'rb') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.endswith(b'\n'):
+                break   # Only the last line can lack its newline
+            try:
+                written.add(json.loads(line.decode('utf-8'))['id'])
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError("Line %d of %s is not a prediction (%s); fix or remove it to resume" % (line_number, path, e))
+            complete += len(line)
+    if complete < os.path.getsize(path):
+        logging.info("Dropping an incomplete last line of %s" % path)
+        with open(path, 'r+b') as f:
+            f.truncate(complete)
+    return written
+
+
+def answer_batches(sess, model, questions, vocab, rev_vocab, paragraph_cache=None):
+    """
+    Answers questions, an iterable of (uuid, context, question), FLAGS.batch_size at a time,
+    yielding the [(uuid, answer)] of each batch as soon as it is answered
+    """
+    def answer_batch(batch):
+        uuids, contexts, offsets, paragraphs, questions = zip(*batch)
+        questions_padded, questions_masked = pad_inputs(questions, FLAGS.max_question_size)
+        paragraphs_padded, paragraphs_masked = pad_inputs(paragraphs, FLAGS.max_paragraph_size)
+        spans = model.answer_batch(sess, questions_padded, paragraphs_padded, questions_masked, paragraphs_masked,
+                                   batch_size=len(batch), paragraph_cache=paragraph_cache)
+        return [(uuid, span_text(paragraph, span, context, context_offsets, rev_vocab))
+                for uuid, context, context_offsets, paragraph, span in zip(uuids, contexts, offsets, paragraphs_padded, spans)]
+
+    last_context, context_offsets, paragraph = None, None, None
+    batch = []
+    for uuid, context, question in questions:
+        if context != last_context:
+            # Questions of a paragraph come one after the other, so it is tokenized once for all of them
+            context_tokens, context_offsets = tokenize_context(context)
+            paragraph = [vocab.get(w, qa_data.UNK_ID) for w in context_tokens]
+            last_context = context
+        batch.append((uuid, context, context_offsets, paragraph, [vocab.get(w, qa_data.UNK_ID) for w in tokenize(question)]))
+
+        if len(batch) == FLAGS.batch_size:
+            yield answer_batch(batch)
+            batch = []
+    if batch:
+        yield answer_batch(batch)
+
+
+def stream_answers(sess, model, questions, vocab, rev_vocab, output_path):
+    """
+    Answers questions, an iterable of (uuid, context, question), FLAGS.batch_size at a time and
+    appends {"id", "answer"} lines to output_path after every batch, so memory does not grow
+    with the number of questions and a rerun carries on after the last batch written.
+    """
+    written = read_written_ids(output_path)
+    if written:
+        logging.info("Resuming: %d questions already answered in %s" % (len(written), output_path))
+    paragraph_cache = ParagraphCache(FLAGS.paragraph_cache) if FLAGS.paragraph_cache > 0 else None
+
+    skipped = [0]
+    def unanswered():
+        for uuid, context, question in questions:
+            if uuid in written:
+                skipped[0] += 1
+            else:
+                yield uuid, context, question
+
+    tic = time.time()
+    answered = 0
+    with io.open(output_path, 'a', encoding='utf-8') as out:
+        for answers in answer_batches(sess, model, unanswered(), vocab, rev_vocab, paragraph_cache):
+            for uuid, answer in answers:
+                out.write(unicode(json.dumps({"id": uuid, "answer": answer}, ensure_ascii=False)) + u'\n')
+            out.flush()
+            answered += len(answers)
+            if answered % (10 * FLAGS.batch_size) == 0:
+                logging.info("Answered %d questions (%.1f per sec)" % (answered, answered / (time.time() - tic)))
+
+    logging.info("Answered %d questions in %.2f secs, skipped %d already in %s" % (answered, time.time() - tic, skipped[0], output_path))
+    if paragraph_cache is not None:
+        logging.info(paragraph_cache.summary())
+
+
+def build_model(extra_embeddings=None):
+    """
+    The QASystem to answer with: read from FLAGS.frozen_graph when set, otherwise built
+    to be restored from FLAGS.train_dir by restore_model
+    """
+    if FLAGS.frozen_graph:
+        if extra_embeddings is not None and len(extra_embeddings):
+            raise ValueError("--glove_path needs the full model, the frozen graph has its embeddings folded in")
+        return FrozenQASystem(FLAGS.frozen_graph, FLAGS)
+
+    encoder = Encoder(size=FLAGS.state_size, vocab_dim=FLAGS.embedding_size, FLAGS=FLAGS)
+    decoder = Decoder(FLAGS=FLAGS)
+    return QASystem(encoder, decoder, FLAGS, extra_embeddings=extra_embeddings)
+
+
+def restore_model(sess, qa):
+    """
+    Loads the latest checkpoint of FLAGS.train_dir into qa (nothing to do for a frozen graph)
+    """
+    if not FLAGS.frozen_graph:
+        initialize_model(sess, qa, FLAGS.train_dir)
+
+
 def main(_):
 
     vocab, rev_vocab = initialize_vocab(FLAGS.vocab_path)
@@ -142,28 +350,42 @@ def main(_):
     with open(os.path.join(FLAGS.log_dir, "flags.json"), 'w') as fout:
         json.dump(FLAGS.__flags, fout)
 
+    if FLAGS.stream:
+        if FLAGS.glove_path:
+            raise ValueError("--glove_path gives the model embeddings for the words of the whole dev set, so it needs it up front, not --stream")
+        qa = build_model()
+        with tf.Session() as sess:
+            restore_model(sess, qa)
+            stream_answers(sess, qa, read_questions(FLAGS.dev_path), vocab, rev_vocab, FLAGS.stream_output)
+        return
+
     # ========= Load Dataset =========
     # You can change this code to load dataset in your own way
 
     dev_dirname = os.path.dirname(os.path.abspath(FLAGS.dev_path))
     dev_filename = os.path.basename(FLAGS.dev_path)
-    context_data, question_data, question_uuid_data = prepare_dev(dev_dirname, dev_filename, vocab)
-    dataset = {"val_context": context_data, "val_questions": question_data, "val_question_uuids": question_uuid_data}
+    if FLAGS.glove_path:
+        vocab = GloveBackedVocab(vocab, rev_vocab, qa_data.GloveStore(FLAGS.glove_path, FLAGS.embedding_size))
+    context_data, question_data, question_uuid_data, context_text_data, context_offsets_data = prepare_dev(dev_dirname, dev_filename, vocab)
+    extra_embeddings = None
+    if FLAGS.glove_path:
+        extra_embeddings = np.array(vocab.extra_vectors, dtype=np.float32)
+        logging.info("Gave %d dev words outside the vocab their GloVe vectors" % len(extra_embeddings))
+    dataset = {"val_context": context_data, "val_questions": question_data, "val_question_uuids": question_uuid_data,
+               "val_context_text": context_text_data, "val_context_offsets": context_offsets_data}
 
     # ========= Model-specific =========
     # You must change the following code to adjust to your model
 
-    encoder = Encoder(size=FLAGS.state_size, vocab_dim=FLAGS.embedding_size, FLAGS=FLAGS)
-    decoder = Decoder(output_size=FLAGS.output_size, FLAGS=FLAGS)
-
-    qa = QASystem(encoder, decoder, FLAGS)
+    tic = time.time()
+    qa = build_model(extra_embeddings)
 
     with tf.Session() as sess:
-        train_dir = get_normalized_train_dir(FLAGS.train_dir)
+        restore_model(sess, qa)
 
-        train_dir = FLAGS.train_dir
-        print ("train_dir: ", train_dir)
-        initialize_model(sess, qa, train_dir)
+        # Cold start: building or loading the model plus the first session.run, which sets up the graph
+        qa.answer(sess, *first_example(dataset))
+        logging.info("Cold start to first answer: %.2f secs (%s)" % (time.time() - tic, FLAGS.frozen_graph or "checkpoint"))
 
         answers = generate_answers(sess, qa, dataset, rev_vocab)
 
@@ -0,0 +1,287 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import os
+import json
+import time
+import threading
+import subprocess
+import traceback
+import multiprocessing
+
+import numpy as np
+from six.moves import queue
+import tensorflow as tf
+
+from paragraph_cache import ParagraphCache
+from utils import initialize_vocab
+from qa_answer import FLAGS, read_questions, answer_batches, build_model, restore_model
+
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+# The model flags are qa_answer.py's; the questions are read from dev_path
+tf.app.flags.DEFINE_integer("workers", 2, "Worker processes, each answering with its own session.")
+tf.app.flags.DEFINE_string("worker_scaling", "", "Comma separated worker counts (e.g. 1,2,4) to run the whole job with one after the other, reporting questions/sec of each (default: just --workers).")
+tf.app.flags.DEFINE_string("cores", "", "Comma separated CPU ids to split between the workers (default: all this process may run on).")
+tf.app.flags.DEFINE_bool("pin_cores", True, "Pin each worker to its own subset of cores.")
+tf.app.flags.DEFINE_integer("intra_op_threads", 0, "Threads a worker runs one op with (default: the cores of its subset).")
+tf.app.flags.DEFINE_integer("inter_op_threads", 0, "Ops a worker runs at once (default: 2, the forward and backward LSTMs, if it has the cores).")
+tf.app.flags.DEFINE_integer("shard_size", 1000, "Questions workers take from the queue at a time; keep it a multiple of batch_size.")
+tf.app.flags.DEFINE_string("bulk_output", "dev-prediction.json", "Prediction file to merge the answers into: JSON, or JSONL in question order if it ends in .jsonl (default: ./dev-prediction.json)")
+
+
+def available_cores():
+    """
+    The CPU ids this process may run on
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("Cpus_allowed_list:"):
+                    return parse_cores(line.split(":", 1)[1])
+    except IOError:
+        pass
+    return list(range(multiprocessing.cpu_count()))
+
+
+def parse_cores(spec):
+    """
+    CPU ids of a list like 0,2,4-7
+    """
+    cores = []
+    for part in spec.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cores.extend(range(int(first), int(last) + 1))
+        elif part:
+            cores.append(int(part))
+    return cores
+
+
+def core_groups(cores, workers):
+    """
+    Splits cores into workers contiguous subsets differing in size by at most one, or gives
+    the workers one core each, round robin, when there are more workers than cores
+    """
+    if workers > len(cores):
+        logging.warning("%d workers on %d cores: workers will share cores" % (workers, len(cores)))
+        return [[cores[i % len(cores)]] for i in range(workers)]
+    return [[int(core) for core in group] for group in np.array_split(cores, workers)]
+
+
+def pin_to_cores(cores):
+    """
+    Restricts this process, and the threads it starts later, to cores
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+        return
+    try:
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(["taskset", "-a", "-p", "-c", ",".join(str(core) for core in cores), str(os.getpid())],
+                                  stdout = devnull)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.warning("Could not pin worker %d to cores %s, running unpinned: %s" % (os.getpid(), cores, e))
+
+
+def run_worker(worker_id, cores, shards, results, start):
+    """
+    Loads the model once, then answers shards, (shard id, [(uuid, context, question)]) from the
+    shards queue, until it takes a None. Puts ("ready", worker id, load secs), then
+    ("shard", worker id, shard id, [(uuid, answer)]) per shard and ("done", worker id, stats)
+    on results, or ("error", worker id, traceback) if anything fails.
+    """
+    try:
+        if FLAGS.pin_cores:
+            # Before the session starts its thread pools, which inherit the affinity
+            pin_to_cores(cores)
+        config = tf.ConfigProto(intra_op_parallelism_threads = FLAGS.intra_op_threads or len(cores),
+                                inter_op_parallelism_threads = FLAGS.inter_op_threads or min(2, len(cores)))
+
+        tic = time.time()
+        vocab, rev_vocab = initialize_vocab(FLAGS.vocab_path)
+        qa = build_model()
+        with tf.Session(config = config) as sess:
+            restore_model(sess, qa)
+            results.put(("ready", worker_id, time.time() - tic))
+            start.wait()
+
+            paragraph_cache = ParagraphCache(FLAGS.paragraph_cache) if FLAGS.paragraph_cache > 0 else None
+            answered, busy = 0, 0.0
+            while True:
+                shard = shards.get()
+                if shard is None:
+                    break
+                shard_id, questions = shard
+                tic = time.time()
+                answers = [answer for batch in answer_batches(sess, qa, questions, vocab, rev_vocab, paragraph_cache)
+                           for answer in batch]
+                busy += time.time() - tic
+                answered += len(answers)
+                results.put(("shard", worker_id, shard_id, answers))
+
+            results.put(("done", worker_id, {"answered": answered, "busy_secs": busy,
+                                             "paragraphs_encoded": paragraph_cache.encoded if paragraph_cache else answered}))
+    except Exception:
+        results.put(("error", worker_id, traceback.format_exc()))
+
+
+def feed_shards(questions, shards, workers, failure):
+    """
+    Puts questions on the shards queue FLAGS.shard_size at a time, in order, then a None per worker
+    """
+    try:
+        shard = []
+        shard_id = 0
+        for question in questions:
+            shard.append(question)
+            if len(shard) == FLAGS.shard_size:
+                shards.put((shard_id, shard))
+                shard_id += 1
+                shard = []
+        if shard:
+            shards.put((shard_id, shard))
+    except Exception:
+        failure.append(traceback.format_exc())
+    finally:
+        for _ in range(workers):
+            shards.put(None)
+
+
+class PredictionWriter(object):
+    """
+    Merges shards answered out of order into one prediction file: a JSON object written at
+    the end, or JSONL lines written as soon as the shards before them are in
+    """
+    def __init__(self, path):
+        self.path = path
+        self.jsonl = path.endswith(".jsonl")
+        self.answers = {}
+        self.pending = {}
+        self.next_shard = 0
+        self.out = io.open(path, "w", encoding = "utf-8") if self.jsonl else None
+
+    def add(self, shard_id, answers):
+        if not self.jsonl:
+            self.answers.update(answers)
+            return
+        self.pending[shard_id] = answers
+        while self.next_shard in self.pending:
+            for uuid, answer in self.pending.pop(self.next_shard):
+                self.out.write(unicode(json.dumps({"id": uuid, "answer": answer}, ensure_ascii = False)) + u"\n")
+            self.next_shard += 1
+
+    def close(self, complete=True):
+        """
+        :param complete: whether every shard is in; a JSON file is only written then
+        """
+        if self.jsonl:
+            self.out.close()
+        elif complete:
+            with io.open(self.path, "w", encoding = "utf-8") as f:
+                f.write(unicode(json.dumps(self.answers, ensure_ascii = False)))
+
+
+def run_bulk(workers, cores, output_path):
+    """
+    Answers every question of FLAGS.dev_path with workers processes, merging their answers into
+    output_path
+
+    :return: dict of the run's questions, secs and questions/sec
+    """
+    groups = core_groups(cores, workers)
+    shards = multiprocessing.Queue(maxsize = 2 * workers)    # The feeder stays just ahead of the workers
+    results = multiprocessing.Queue()
+    start = multiprocessing.Event()
+    processes = [multiprocessing.Process(target = run_worker, args = (i, group, shards, results, start))
+                 for i, group in enumerate(groups)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+
+    stats = {}
+    def next_result():
+        while True:
+            try:
+                result = results.get(timeout = 1.0)
+            except queue.Empty:
+                dead = [i for i, process in enumerate(processes) if not process.is_alive() and i not in stats]
+                if dead:
+                    raise RuntimeError("Worker %d exited (code %s)" % (dead[0], processes[dead[0]].exitcode))
+                continue
+            if result[0] == "error":
+                raise RuntimeError("Worker %d failed:\n%s" % (result[1], result[2]))
+            return result
+
+    writer = PredictionWriter(output_path)
+    failure = []
+    elapsed = None
+    try:
+        load_secs = [next_result()[2] for _ in processes]
+        logging.info("%d workers loaded the model in %.2f secs (slowest); cores %s" % (workers, max(load_secs), groups))
+
+        feeder = threading.Thread(target = feed_shards, args = (read_questions(FLAGS.dev_path), shards, workers, failure))
+        feeder.daemon = True
+        tic = time.time()
+        start.set()
+        feeder.start()
+
+        answered = 0
+        while len(stats) < workers:
+            result = next_result()
+            if result[0] == "shard":
+                writer.add(result[2], result[3])
+                answered += len(result[3])
+                logging.info("Merged shard %d from worker %d: %d questions (%.1f per sec)" % (
+                    result[2], result[1], answered, answered / (time.time() - tic)))
+            else:
+                stats[result[1]] = result[2]
+        elapsed = time.time() - tic
+    finally:
+        writer.close(complete = elapsed is not None and not failure)
+        # Shards left when a run fails would otherwise block exit, waiting for a worker to read them
+        shards.cancel_join_thread()
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+    if failure:
+        raise RuntimeError("Reading %s failed:\n%s" % (FLAGS.dev_path, failure[0]))
+
+    for i in sorted(stats):
+        logging.info("Worker %d on cores %s: %d questions, %.1f per sec busy, %d paragraph encodings" % (
+            i, groups[i], stats[i]["answered"], stats[i]["answered"] / max(stats[i]["busy_secs"], 1e-6), stats[i]["paragraphs_encoded"]))
+    logging.info("%d workers answered %d questions in %.2f secs: %.1f questions/sec, written to %s" % (
+        workers, answered, elapsed, answered / elapsed, output_path))
+    return {"workers": workers, "cores_per_worker": min(len(group) for group in groups),
+            "questions": answered, "secs": elapsed, "questions_per_sec": answered / elapsed}
+
+
+def main(_):
+    if FLAGS.glove_path:
+        raise ValueError("--glove_path gives the model embeddings for the words of the whole dev set, so it needs qa_answer.py, not qa_bulk.py")
+    FLAGS.embed_path = FLAGS.embed_path or "data/squad/glove.trimmed.{}.npz".format(FLAGS.embedding_size)
+
+    cores = parse_cores(FLAGS.cores) if FLAGS.cores else available_cores()
+    worker_counts = [int(n) for n in FLAGS.worker_scaling.split(",")] if FLAGS.worker_scaling else [FLAGS.workers]
+    runs = [run_bulk(workers, cores, FLAGS.bulk_output) for workers in worker_counts]
+
+    if len(runs) > 1:
+        logging.info("Scaling on %d cores (%s):" % (len(cores), FLAGS.frozen_graph or "checkpoint"))
+        logging.info("workers  cores/worker  questions/sec  speedup  efficiency")
+        base = runs[0]
+        for run in runs:
+            # Against the first run, and against that run's rate scaled linearly with workers
+            speedup = run["questions_per_sec"] / base["questions_per_sec"]
+            logging.info("%7d  %12d  %13.1f  %6.2fx  %9.0f%%" % (run["workers"], run["cores_per_worker"], run["questions_per_sec"],
+                                                               speedup, 100.0 * speedup * base["workers"] / run["workers"]))
+
+
+if __name__ == "__main__":
+    tf.app.run()
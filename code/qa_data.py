@@ -7,6 +7,7 @@ import os
 import re
 import tarfile
 import argparse
+from multiprocessing import Pool, cpu_count
 
 from six.moves import urllib
 
@@ -35,6 +36,8 @@ def setup_args():
     parser.add_argument("--vocab_dir", default=vocab_dir)
     parser.add_argument("--glove_dim", default=300, type=int)   # Was 100
     parser.add_argument("--random_init", default=True, type=bool)
+    parser.add_argument("--workers", default=cpu_count(), type=int)
+    parser.add_argument("--glove_store", action="store_true")   # Trim from (and build once) the binary GloveStore
     return parser.parse_args()
 
 
@@ -58,6 +61,140 @@ def initialize_vocabulary(vocabulary_path):
         raise ValueError("Vocabulary file %s not found.", vocabulary_path)
 
 
+def _init_glove_worker(vocab_index, glove_path, glove_dim):
+    global _glove_vocab_index, _glove_path, _glove_dim
+    _glove_vocab_index, _glove_path, _glove_dim = vocab_index, glove_path, glove_dim
+
+
+def _glove_chunks(glove_path, workers):
+    file_size = os.path.getsize(glove_path)
+    chunk_size = max(file_size // (64 * workers), 1)
+    return [(start, min(start + chunk_size, file_size)) for start in range(0, file_size, chunk_size)]
+
+
+def _glove_lines(byte_range):
+    """
+    Yields the (word, vector text) of every GloVe line that starts inside byte_range
+    """
+    start, end = byte_range
+    with open(_glove_path, 'rb') as fh:
+        if start > 0:
+            fh.seek(start - 1)
+            fh.readline()   # The line holding byte start - 1 belongs to the previous chunk
+        while fh.tell() < end:
+            line = fh.readline()
+            if not line:
+                break
+            word, _, vector = line.strip().partition(" ")
+            yield word, vector
+
+
+def _match_glove_chunk(byte_range):
+    """
+    Parses the vectors of the GloVe lines in byte_range whose word, capitalized word or
+    upper-cased word is in the vocab
+    :return: (vocab ids, row of the parsed vector for each id, kind of each match, parsed vectors)
+    """
+    ids, rows, kinds, vectors = [], [], [], []
+    for word, vector in _glove_lines(byte_range):
+        matched = False
+        for kind, key in enumerate([word, word.capitalize(), word.upper()]):
+            idx = _glove_vocab_index.get(key)
+            if idx is not None:
+                ids.append(idx)
+                rows.append(len(vectors))
+                kinds.append(kind)
+                matched = True
+        if matched:
+            vectors.append(vector)
+    vectors = np.fromstring(" ".join(vectors), sep=" ").reshape(-1, _glove_dim)
+    return ids, rows, kinds, vectors
+
+
+def _parse_glove_chunk(byte_range):
+    words, vectors = [], []
+    for word, vector in _glove_lines(byte_range):
+        words.append(word)
+        vectors.append(vector)
+    return words, np.fromstring(" ".join(vectors), dtype=np.float32, sep=" ").reshape(-1, _glove_dim)
+
+
+class GloveStore(object):
+    """
+    The full GloVe file converted once into {glove_path}.f32.npy, a memory-mapped
+    [num_words, glove_dim] float32 matrix, and {glove_path}.words, the word of each row.
+    Words are looked up through a dict built when the store is opened.
+    """
+    def __init__(self, glove_path, glove_dim, workers=1):
+        self.vectors_path = glove_path + ".f32.npy"
+        self.words_path = glove_path + ".words"
+        if not (gfile.Exists(self.vectors_path) and gfile.Exists(self.words_path)):
+            self.build(glove_path, glove_dim, workers)
+
+        self.vectors = np.load(self.vectors_path, mmap_mode='r')
+        with open(self.words_path, 'rb') as f:
+            self.words = f.read().split(b"\n")[:-1]
+        self.index = dict((word, row) for row, word in enumerate(self.words))
+
+    def build(self, glove_path, glove_dim, workers):
+        print("Converting {} into a binary GloVe store".format(glove_path))
+        with open(glove_path, 'rb') as f:
+            num_words = sum(block.count(b"\n") for block in iter(lambda: f.read(1 << 24), b""))
+
+        vectors = np.lib.format.open_memmap(self.vectors_path + ".tmp", mode="w+", dtype=np.float32, shape=(num_words, glove_dim))
+        row = 0
+        pool = Pool(workers, initializer=_init_glove_worker, initargs=(None, glove_path, glove_dim))
+        try:
+            with open(self.words_path + ".tmp", 'wb') as words_file:
+                for words, chunk in tqdm(pool.imap(_parse_glove_chunk, _glove_chunks(glove_path, workers))):
+                    vectors[row : row + len(chunk)] = chunk
+                    row += len(chunk)
+                    words_file.write(b"".join(word + b"\n" for word in words))
+        finally:
+            pool.close()
+            pool.join()
+        assert row == num_words, "Expected {} GloVe lines, parsed {}".format(num_words, row)
+
+        vectors.flush()
+        del vectors
+        os.rename(self.vectors_path + ".tmp", self.vectors_path)
+        os.rename(self.words_path + ".tmp", self.words_path)
+
+    def lookup(self, word):
+        """
+        :return: float32 vector of word (or of its lower-cased form), None if GloVe has neither
+        """
+        row = self.index.get(word, self.index.get(word.lower()))
+        return None if row is None else np.array(self.vectors[row])
+
+    def trim(self, vocab_list, random_init=True):
+        """
+        Same matrix process_glove builds by scanning the text file (up to float32 precision):
+        a vocab word gets the vector of the last GloVe word that equals it exactly, capitalized
+        or upper-cased
+        :return: ([len(vocab_list), glove_dim] float64 matrix, [exact, capitalized, upper-case]
+                 match counts, counted per GloVe line as process_glove does)
+        """
+        vocab_index = dict((word, idx) for idx, word in enumerate(vocab_list))
+        last_row = {}
+        found = [0, 0, 0]
+        for row, word in enumerate(self.words):
+            for kind, key in enumerate([word, word.capitalize(), word.upper()]):
+                if key in vocab_index:
+                    last_row[vocab_index[key]] = row
+                    found[kind] += 1
+
+        glove_dim = self.vectors.shape[1]
+        if random_init:
+            glove = np.random.randn(len(vocab_list), glove_dim)
+        else:
+            glove = np.zeros((len(vocab_list), glove_dim))
+        ids = np.array(sorted(last_row), dtype=np.int64)
+        if len(ids):
+            glove[ids] = self.vectors[np.array([last_row[idx] for idx in ids])]
+        return glove, found
+
+
 def process_glove(args, vocab_list, save_path, size=1900000, random_init=True):
     """
     :param vocab_list: [vocab]
@@ -65,51 +202,66 @@ def process_glove(args, vocab_list, save_path, size=1900000, random_init=True):
     """
     if not gfile.Exists(save_path + ".npz"):
         glove_path = os.path.join(args.glove_dir, "glove.42B.{}d.txt".format(args.glove_dim))
-        if random_init:
-            glove = np.random.randn(len(vocab_list), args.glove_dim)
+        if args.glove_store:
+            glove, found = GloveStore(glove_path, args.glove_dim, args.workers).trim(vocab_list, random_init)
         else:
-            glove = np.zeros((len(vocab_list), args.glove_dim))
-        found = 0
-        with open(glove_path, 'r') as fh:
-            for line in tqdm(fh, total=size):
-                array = line.lstrip().rstrip().split(" ")
-                word = array[0]
-                vector = list(map(float, array[1:]))
-                if word in vocab_list:
-                    idx = vocab_list.index(word)
-                    glove[idx, :] = vector
-                    found += 1
-                if word.capitalize() in vocab_list:
-                    idx = vocab_list.index(word.capitalize())
-                    glove[idx, :] = vector
-                    found += 1
-                if word.upper() in vocab_list:
-                    idx = vocab_list.index(word.upper())
-                    glove[idx, :] = vector
-                    found += 1
-
-        print("{}/{} of word vocab have corresponding vectors in {}".format(found, len(vocab_list), glove_path))
+            if random_init:
+                glove = np.random.randn(len(vocab_list), args.glove_dim)
+            else:
+                glove = np.zeros((len(vocab_list), args.glove_dim))
+
+            # Vocab lookups go through a dict, and the file is scanned in byte ranges by a process pool
+            vocab_index = dict((word, idx) for idx, word in enumerate(vocab_list))
+            chunks = _glove_chunks(glove_path, args.workers)
+
+            found = [0, 0, 0]   # exact, capitalized and upper-case matches
+            pool = Pool(args.workers, initializer=_init_glove_worker, initargs=(vocab_index, glove_path, args.glove_dim))
+            try:
+                # Chunks come back in file order, so later lines overwrite earlier ones just like a serial scan
+                for ids, rows, kinds, vectors in tqdm(pool.imap(_match_glove_chunk, chunks), total=len(chunks)):
+                    for idx, row, kind in zip(ids, rows, kinds):
+                        glove[idx, :] = vectors[row]
+                        found[kind] += 1
+            finally:
+                pool.close()
+                pool.join()
+
+        print("{}/{} of word vocab have corresponding vectors in {}".format(sum(found), len(vocab_list), glove_path))
+        print("Matches: {} exact, {} capitalized, {} upper-case".format(*found))
         np.savez_compressed(save_path, glove=glove)
         print("saved trimmed glove matrix at: {}".format(save_path))
 
 
-def create_vocabulary(vocabulary_path, data_paths, tokenizer=None):
+def context_line_counts(context_id_path):
+    """
+    How many questions point to each line of a context file, so a vocabulary built from
+    the unique contexts counts words as often as when every question had its own copy
+    """
+    return np.bincount(np.fromfile(context_id_path, dtype=np.int64, sep=' '))
+
+
+def create_vocabulary(vocabulary_path, data_paths, tokenizer=None, line_counts=None):
+    """
+    :param line_counts: optional dict of data path to the number of times each of its lines counts
+    """
     if not gfile.Exists(vocabulary_path):
         print("Creating vocabulary %s from data %s" % (vocabulary_path, str(data_paths)))
         vocab = {}
         for path in data_paths:
+            counts = (line_counts or {}).get(path)
             with open(path, mode="rb") as f:
                 counter = 0
                 for line in f:
+                    weight = 1 if counts is None else int(counts[counter]) if counter < len(counts) else 0
                     counter += 1
                     if counter % 100000 == 0:
                         print("processing line %d" % counter)
                     tokens = tokenizer(line) if tokenizer else basic_tokenizer(line)
                     for w in tokens:
                         if w in vocab:
-                            vocab[w] += 1
+                            vocab[w] += weight
                         else:
-                            vocab[w] = 1
+                            vocab[w] = weight
         vocab_list = _START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
         print("Vocabulary size: %d" % len(vocab_list))
         with gfile.GFile(vocabulary_path, mode="wb") as vocab_file:
@@ -149,11 +301,14 @@ if __name__ == '__main__':
     valid_path = pjoin(args.source_dir, "val")
     dev_path = pjoin(args.source_dir, "dev")
 
+    # Contexts are stored once per paragraph; count them once per question, as before
     create_vocabulary(vocab_path,
                       [pjoin(args.source_dir, "train.context"),
                        pjoin(args.source_dir, "train.question"),
                        pjoin(args.source_dir, "val.context"),
-                       pjoin(args.source_dir, "val.question")])
+                       pjoin(args.source_dir, "val.question")],
+                      line_counts={pjoin(args.source_dir, "train.context"): context_line_counts(train_path + ".context_id"),
+                                   pjoin(args.source_dir, "val.context"): context_line_counts(valid_path + ".context_id")})
     vocab, rev_vocab = initialize_vocabulary(pjoin(args.vocab_dir, "vocab.dat"))
 
     # ======== Trim Distributed Word Representation =======
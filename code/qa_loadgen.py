@@ -0,0 +1,99 @@
+""" Load generator for qa_server.py: replays the questions of a SQuAD JSON file from concurrent clients. """
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import sys
+import threading
+import time
+
+import numpy as np
+import six
+from six.moves import http_client
+
+
+def read_questions(dataset_file):
+    """
+    :return: list of (question id, context, question), in file order
+    """
+    with open(dataset_file) as f:
+        dataset = json.load(f)['data']
+    return [(qa['id'], paragraph['context'], qa['question'])
+            for article in dataset for paragraph in article['paragraphs'] for qa in paragraph['qas']]
+
+
+def run_client(host, port, questions, next_index, lock, results):
+    """
+    Sends questions one at a time over one keep-alive connection until next_index runs out,
+    appending (question id, answer or None, latency in seconds) to results
+    """
+    connection = http_client.HTTPConnection(host, port)
+    while True:
+        with lock:
+            i = next_index[0]
+            if i >= len(questions):
+                break
+            next_index[0] += 1
+        question_id, context, question = questions[i]
+        body = json.dumps({'context': context, 'question': question})
+
+        tic = time.time()
+        try:
+            connection.request('POST', '/answer', body, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            reply = json.loads(response.read().decode('utf-8'))
+            answer = reply.get('answer') if response.status == 200 else None
+        except (http_client.HTTPException, IOError) as e:
+            print('Request for {} failed: {}'.format(question_id, e), file=sys.stderr)
+            connection.close()
+            connection = http_client.HTTPConnection(host, port)
+            answer = None
+        results.append((question_id, answer, time.time() - tic))
+    connection.close()
+
+
+def get_metrics(host, port):
+    connection = http_client.HTTPConnection(host, port)
+    connection.request('GET', '/metrics')
+    metrics = json.loads(connection.getresponse().read().decode('utf-8'))
+    connection.close()
+    return metrics
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay SQuAD questions against qa_server.py')
+    parser.add_argument('dataset_file', help='SQuAD JSON file to take contexts and questions from')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--concurrency', type=int, default=8, help='Clients, each with one request in flight')
+    parser.add_argument('--requests', type=int, default=0, help='Requests to send, cycling through the questions (default: each question once)')
+    parser.add_argument('--predictions', default='', help='Write the answers as a prediction file for evaluate.py')
+    args = parser.parse_args()
+
+    questions = read_questions(args.dataset_file)
+    if args.requests:
+        questions = [questions[i % len(questions)] for i in range(args.requests)]
+
+    next_index, lock, results = [0], threading.Lock(), []
+    clients = [threading.Thread(target=run_client, args=(args.host, args.port, questions, next_index, lock, results))
+               for _ in range(args.concurrency)]
+    tic = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - tic
+
+    latencies = np.array([latency for _, _, latency in results]) * 1000
+    failed = sum(answer is None for _, answer, _ in results)
+    print('{} requests ({} failed) from {} clients in {:.2f} s: {:.1f} requests/s'.format(
+        len(results), failed, args.concurrency, elapsed, len(results) / elapsed))
+    print('Client latency ms: p50 {:.1f}, p95 {:.1f}, p99 {:.1f}'.format(*np.percentile(latencies, [50, 95, 99])))
+    print('Server metrics: ' + json.dumps(get_metrics(args.host, args.port), sort_keys=True))
+
+    if args.predictions:
+        predictions = dict((question_id, answer) for question_id, answer, _ in results if answer is not None)
+        with io.open(args.predictions, 'w', encoding='utf-8') as f:
+            f.write(six.text_type(json.dumps(predictions, ensure_ascii=False)))
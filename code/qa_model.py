@@ -20,8 +20,12 @@ from tensorflow.python.ops.nn import sparse_softmax_cross_entropy_with_logits
 from tensorflow.python.ops.nn import bidirectional_dynamic_rnn
 from tensorflow.python.ops.nn import dynamic_rnn
 
-from evaluate import exact_match_score, f1_score
-from utils import beta_summaries
+from evaluate import FastEvaluator
+from utils import beta_summaries, trim_to_longest, load_embeddings
+from batching import BucketSampler, EpochSampler, ParagraphSampler, BatchPrefetcher, PaddingReport
+from decoding import best_spans, nbest_spans
+from checkpoint import CheckpointWriter
+from dataset import mask_from_lengths
 
 logging.basicConfig(level=logging.INFO)
 
@@ -38,14 +42,19 @@ def get_optimizer(opt):
 class MatchLSTMCell(tf.nn.rnn_cell.BasicLSTMCell):
     """
     Extension of LSTM cell to do matching and magic. Designed to be fed to dynammic_rnn
+
+    With projection_slot set, each input is [hp_i, projections...] and the hp_i * WP + bP term of this
+    cell is read from slot projection_slot (see paragraph_projection) instead of being computed every step.
+    Everything else that only depends on HQ is then also laid out once, outside of the recurrence.
     """
-    def __init__(self, hidden_size, HQ, FLAGS):
+    def __init__(self, hidden_size, HQ, FLAGS, projection_slot=None):
          # Uniform distribution, as opposed to xavier, which is normal
         self.HQ = HQ
         self.hidden_size = hidden_size
         self.FLAGS = FLAGS
+        self.projection_slot = projection_slot
 
-        l, P, Q = self.hidden_size, self.FLAGS.max_paragraph_size, self.FLAGS.max_question_size
+        l = self.hidden_size
         self.WQ = tf.get_variable("WQ", [l,l], initializer=tf.uniform_unit_scaling_initializer(1.0)) 
         self.WP = tf.get_variable("WP", [l,l], initializer=tf.uniform_unit_scaling_initializer(1.0))
         self.WR = tf.get_variable("WR", [l,l], initializer=tf.uniform_unit_scaling_initializer(1.0))
@@ -57,11 +66,26 @@ class MatchLSTMCell(tf.nn.rnn_cell.BasicLSTMCell):
         # Calculate term1 by resphapeing to l
         HQ_shaped = tf.reshape(HQ, [-1, l])
         term1 = tf.matmul(HQ_shaped, self.WQ)
-        term1 = tf.reshape(term1, [-1, Q, l])
+        term1 = tf.reshape(term1, tf.shape(HQ))    # Q varies from batch to batch
+        term1.set_shape([None, None, l])
         self.term1 = term1
 
+        if projection_slot is not None:
+            # [Q, None, l] term1 lets the per-step [None, l] term broadcast over the leading dim (a cheap row
+            # broadcast), and HQ^T for the attention product does not have to be transposed at every step
+            self.term1_by_question = tf.transpose(term1, [1, 0, 2])
+            self.HQ_transposed = tf.transpose(HQ, [0, 2, 1])
+
         super(MatchLSTMCell, self).__init__(hidden_size)
 
+    def paragraph_projection(self, HP):
+        """
+        HP * WP + bP for every paragraph position at once, outside of the recurrence
+        """
+        l = self.hidden_size
+        projection = tf.matmul(tf.reshape(HP, [-1, l]), self.WP) + self.bP
+        return tf.reshape(projection, tf.shape(HP))
+
     def __call__(self, inputs, state, scope = None):
         """
         inputs: a batch representation (HP at each word i) that is inputs = hp_i and are [None, l]
@@ -72,36 +96,53 @@ class MatchLSTMCell(tf.nn.rnn_cell.BasicLSTMCell):
         term1 = self.term1
         WQ, WP, WR = self.WQ, self.WP, self.WR
         bP, w, b = self.bP, self.w, self.b
-        l, P, Q = self.hidden_size, self.FLAGS.max_paragraph_size, self.FLAGS.max_question_size
+        l = self.hidden_size
         HQ = self.HQ
+        Q = tf.shape(HQ)[1]
         hr = state[1]
-        hp_i = inputs
 
-        # Check correct input dimensions
-        assert hr.get_shape().as_list() == [None, l]
-        assert hp_i.get_shape().as_list() == [None, l]
+        if self.projection_slot is None:
+            hp_i = inputs
+
+            # Extend a [None, l] matrix by dim Q (Q is only known at run time)
+            term2 = tf.matmul(hp_i,WP) + tf.matmul(hr, WR) + bP
+            term2 = tf.tile(tf.expand_dims(term2, 1), [1, Q, 1])
+
+            # Check correct term dimensions for use
+            assert term1.get_shape().as_list() == [None, None, l]
+            assert term2.get_shape().as_list() == [None, None, l]
+
+            # Yeah pretty sure we need this lol
+            G_i = tf.tanh(term1 + term2)
+
+            # Reshape to multiply against w
+            G_i_shaped = tf.reshape(G_i, [-1, l])
+            a_i = tf.matmul(G_i_shaped, w) + b
+            a_i = tf.reshape(a_i, [-1, Q, 1])
+
+            HQ_shaped = tf.transpose(HQ, [0,2,1])
+        else:
+            hp_i = tf.slice(inputs, [0, 0], [-1, l])
+            hp_projection = tf.slice(inputs, [0, self.projection_slot * l], [-1, l])
 
-        # Way to extent a [None, l] matrix by dim Q (kinda a hack)
-        term2 = tf.matmul(hp_i,WP) + tf.matmul(hr, WR) + bP
-        term2 = tf.transpose(tf.stack([term2 for _ in range(Q)]), [1,0,2])
+            # Precomputed hp_i * WP + bP, broadcast over the question positions of [Q, None, l] term1
+            term2 = hp_projection + tf.matmul(hr, WR)
+            G_i = tf.tanh(self.term1_by_question + term2)
 
-        # Check correct term dimensions for use
-        assert term1.get_shape().as_list() == [None, Q, l]
-        assert term2.get_shape().as_list() == [None, Q, l]
+            # Multiply against w, then back to [None, Q, 1]
+            a_i = tf.matmul(tf.reshape(G_i, [-1, l]), w) + b
+            a_i = tf.expand_dims(tf.transpose(tf.reshape(a_i, [Q, -1])), 2)
 
-        # Yeah pretty sure we need this lol
-        G_i = tf.tanh(term1 + term2)
+            HQ_shaped = self.HQ_transposed
 
-        # Reshape to multiply against w
-        G_i_shaped = tf.reshape(G_i, [-1, l])
-        a_i = tf.matmul(G_i_shaped, w) + b
-        a_i = tf.reshape(a_i, [-1, Q, 1])
+        # Check correct input dimensions
+        assert hr.get_shape().as_list() == [None, l]
+        assert hp_i.get_shape().as_list() == [None, l]
 
         # Check that the attention matrix is properly shaped (3rd dim useful for batch_matmul in next step)
-        assert a_i.get_shape().as_list() == [None, Q, 1]
+        assert a_i.get_shape().as_list() == [None, None, 1]
 
-        # Prepare dims, and mult attn with question representation in each element of the batch
-        HQ_shaped = tf.transpose(HQ, [0,2,1])
+        # Mult attn with question representation in each element of the batch
         z_comp = tf.batch_matmul(HQ_shaped, a_i)
         z_comp = tf.squeeze(z_comp, [2])
 
@@ -125,43 +166,59 @@ class Encoder(object):
         self.vocab_dim = vocab_dim
         self.FLAGS = FLAGS
 
-    def encode(self, input_question, input_paragraph, question_length, paragraph_length, encoder_state_input = None):    # LSTM Preprocessing and Match-LSTM Layers
+    def encode_paragraph(self, input_paragraph, paragraph_length):
+        """
+        The question-independent part of the encoding: the preprocessing LSTM over the paragraph
+        """
+        with tf.variable_scope("paragraph_encode"):
+            cell2 = tf.nn.rnn_cell.BasicLSTMCell(self.size)
+            HP, _ = tf.nn.dynamic_rnn(cell2, input_paragraph, sequence_length = paragraph_length, dtype = tf.float32)   #sequence length masks dynamic_rnn
+        return HP
+
+    def encode(self, input_question, input_paragraph, question_length, paragraph_length, encoder_state_input = None, paragraph_encoding = None):    # LSTM Preprocessing and Match-LSTM Layers
         """
         Description:
+
+        paragraph_encoding: HP from encode_paragraph, if it was already built (default: built here)
         """
 
-        assert input_question.get_shape().as_list() == [None, self.FLAGS.max_question_size, self.FLAGS.embedding_size]
-        assert input_paragraph.get_shape().as_list() == [None, self.FLAGS.max_paragraph_size, self.FLAGS.embedding_size]
+        # Question and paragraph lengths are per batch (padded to the batch's longest), so only the last dim is static
+        assert input_question.get_shape().as_list() == [None, None, self.FLAGS.embedding_size]
+        assert input_paragraph.get_shape().as_list() == [None, None, self.FLAGS.embedding_size]
 
         #Preprocessing LSTM
         with tf.variable_scope("question_encode"):
             cell = tf.nn.rnn_cell.BasicLSTMCell(self.size) #self.size passed in through initialization from "state_size" flag
             HQ, _ = tf.nn.dynamic_rnn(cell, input_question, sequence_length = question_length,  dtype = tf.float32)
 
-        with tf.variable_scope("paragraph_encode"):
-            cell2 = tf.nn.rnn_cell.BasicLSTMCell(self.size)
-            HP, _ = tf.nn.dynamic_rnn(cell2, input_paragraph, sequence_length = paragraph_length, dtype = tf.float32)   #sequence length masks dynamic_rnn
+        HP = paragraph_encoding if paragraph_encoding is not None else self.encode_paragraph(input_paragraph, paragraph_length)
 
-        assert HQ.get_shape().as_list() == [None, self.FLAGS.max_question_size, self.FLAGS.state_size]
-        assert HP.get_shape().as_list() == [None, self.FLAGS.max_paragraph_size, self.FLAGS.state_size]
+        assert HQ.get_shape().as_list() == [None, None, self.FLAGS.state_size]
+        assert HP.get_shape().as_list() == [None, None, self.FLAGS.state_size]
 
         # Encoding params
         l = self.size
-        Q = self.FLAGS.max_question_size
-        P = self.FLAGS.max_paragraph_size
 
         # Initialize forward and backward matching LSTMcells with same matching params
+        fast = self.FLAGS.fast_match_lstm
         with tf.variable_scope("forward"):
-            cell_f = MatchLSTMCell(l, HQ, self.FLAGS) 
+            cell_f = MatchLSTMCell(l, HQ, self.FLAGS, projection_slot = 1 if fast else None) 
         with tf.variable_scope("backward"):
-            cell_b = MatchLSTMCell(l, HQ, self.FLAGS)
+            cell_b = MatchLSTMCell(l, HQ, self.FLAGS, projection_slot = 2 if fast else None)
+
+        if fast:
+            # The paragraph projections don't depend on the recurrence, so compute them once for all of HP
+            # and feed them next to HP: each time step is then [hp_i, forward projection, backward projection]
+            match_inputs = tf.concat(2, [HP, cell_f.paragraph_projection(HP), cell_b.paragraph_projection(HP)])
+        else:
+            match_inputs = HP
 
         # Calculate encodings for both forward and backward directions
-        (HR_right, HR_left), _ = tf.nn.bidirectional_dynamic_rnn(cell_f, cell_b, HP, sequence_length = paragraph_length, dtype = tf.float32)
+        (HR_right, HR_left), _ = tf.nn.bidirectional_dynamic_rnn(cell_f, cell_b, match_inputs, sequence_length = paragraph_length, dtype = tf.float32)
         
         ### Append the two things calculated above into H^R
         HR = tf.concat(2,[HR_right, HR_left])
-        assert HR.get_shape().as_list() == [None, P, 2*l]
+        assert HR.get_shape().as_list() == [None, None, 2*l]
     
         return HR
 
@@ -178,7 +235,7 @@ class Decoder(object):
 
         # Decode Params
         l = self.FLAGS.state_size
-        P = self.FLAGS.max_paragraph_size
+        P = tf.shape(knowledge_rep)[1]
         Hr = knowledge_rep  
 
         # Decode variables
@@ -199,74 +256,84 @@ class Decoder(object):
         cell_state = (hk, hk)
         assert hk.get_shape().as_list() == [None, l] 
 
+        # Hr and V are the same for both pointers, so project once. Keeping term1 as [P, None, l]
+        # lets the per-pointer [None, l] term broadcast over the leading dim
+        Hr_shaped = tf.reshape(tf.transpose(Hr, [1, 0, 2]), [-1, 2*l])
+        term1 = tf.matmul(Hr_shaped, V)
+        term1 = tf.reshape(term1, [P, -1, l])
+        assert term1.get_shape().as_list() == [None, None, l] 
+
+        # Huge negative logits for padding, so the softmax only spreads over the paragraph
+        mask_term = (tf.cast(paragraph_mask, tf.float32) - 1) * 1e30
+        Hr_shaped_cell = tf.transpose(Hr, [0, 2, 1])
+
         # Just two iterations of decoding for the start point and then the end point
         for i, _ in enumerate(preds):  
             if i > 0: #Round 2 should reuse variables from before
                 tf.get_variable_scope().reuse_variables()
 
-            # Mult and extend using hack to get shape compatable
+            # Mult, then broadcast over dim P in the add
             term2 = tf.matmul(hk,Wa) + ba 
-            term2 = tf.transpose(tf.stack([term2 for _ in range(P)]), [1,0,2]) 
-            assert term2.get_shape().as_list() == [None, P, l] 
-            
-            # Reshape and matmul
-            Hr_shaped = tf.reshape(Hr, [-1, 2*l])
-            term1 = tf.matmul(Hr_shaped, V)
-            term1 = tf.reshape(term1, [-1, P, l])
-            assert term1.get_shape().as_list() == [None, P, l] 
+            assert term2.get_shape().as_list() == [None, l] 
 
             # Add terms and tanh them
             Fk = tf.tanh(term1 + term2)
-            assert Fk.get_shape().as_list() == [None, P, l] 
+            assert Fk.get_shape().as_list() == [None, None, l] 
 
-            # Generate beta_term v^T * Fk + c * e(P)
+            # Generate beta_term v^T * Fk + c * e(P), back in [None, P]
             Fk_shaped = tf.reshape(Fk, [-1, l])
             beta_term = tf.matmul(Fk_shaped, v) + c
-            beta_term = tf.reshape(beta_term ,[-1, P, 1])
-            assert beta_term.get_shape().as_list() == [None, P, 1] 
+            beta_term = tf.transpose(tf.reshape(beta_term, [P, -1]))
+            assert beta_term.get_shape().as_list() == [None, None] 
 
-            # Get Beta (prob dist over the paragraph)
-            beta = tf.nn.softmax(beta_term)
-            assert beta.get_shape().as_list() == [None, P, 1] 
+            # Get Beta (prob dist over the unmasked paragraph positions)
+            beta = tf.nn.softmax(beta_term + mask_term)
+            assert beta.get_shape().as_list() == [None, None] 
 
             # Setup input to LSTM
-            Hr_shaped_cell = tf.transpose(Hr, [0, 2, 1])
-            cell_input = tf.squeeze(tf.batch_matmul(Hr_shaped_cell, beta), [2])
+            cell_input = tf.squeeze(tf.batch_matmul(Hr_shaped_cell, tf.expand_dims(beta, 2)), [2])
             assert cell_input.get_shape().as_list() == [None, 2*l] 
 
             # Ouput and State for next iteration
             hk, cell_state = cell(cell_input, cell_state)
 
             #Save a 2D rep of Beta as output
-            preds[i] = tf.squeeze(beta_term)    # TODO: Do we want beta? Or beta_term?   Beta would be softmaxed twice by this
+            preds[i] = beta_term    # TODO: Do we want beta? Or beta_term?   Beta would be softmaxed twice by this
 
         return tuple(preds) # Bs, Be [batchsize, paragraph_length]
 
 
 class QASystem(object):
-    def __init__(self, encoder, decoder, FLAGS, *args):
+    def __init__(self, encoder, decoder, FLAGS, extra_embeddings=None):
         """
         Initializes your System
 
         :param encoder: an encoder that you constructed in train.py
         :param decoder: a decoder that you constructed in train.py
-        :param args: pass in more arguments as needed
+        :param extra_embeddings: [num_extra, embedding_size] vectors for words outside the training
+                                 vocab, which get ids after it (not saved in checkpoints)
         """
         self.encoder = encoder
         self.decoder = decoder
         self.FLAGS = FLAGS
+        self.extra_embeddings = extra_embeddings
+        self.cell_init_zeros = {}
 
         # ==== set up variables ========
         self.learning_rate = tf.Variable(float(self.FLAGS.learning_rate), trainable = False, name = "learning_rate")
         self.global_step = tf.Variable(int(0), trainable = False, name = "global_step")
 
         # # ==== set up placeholder tokens ======== 3d (because of batching)
-        self.paragraph_placeholder = tf.placeholder(tf.int32, (None, self.FLAGS.max_paragraph_size), name="paragraph_placeholder")
-        self.question_placeholder = tf.placeholder(tf.int32, (None, self.FLAGS.max_question_size), name="question_placeholder")
+        # Paragraphs and questions are padded to the longest one in each batch (at most max_paragraph_size/max_question_size)
+        self.paragraph_placeholder = tf.placeholder(tf.int32, (None, None), name="paragraph_placeholder")
+        self.question_placeholder = tf.placeholder(tf.int32, (None, None), name="question_placeholder")
         self.start_answer_placeholder = tf.placeholder(tf.int32, (None), name="start_answer_placeholder")
         self.end_answer_placeholder = tf.placeholder(tf.int32, (None), name="end_answer_placeholder")
-        self.paragraph_mask_placeholder = tf.placeholder(tf.bool, (None, self.FLAGS.max_paragraph_size), name="paragraph_mask_placeholder")
+        self.paragraph_mask_placeholder = tf.placeholder(tf.bool, (None, None), name="paragraph_mask_placeholder")
         self.paragraph_length = tf.placeholder(tf.int32, (None), name="paragraph_length")
+        # Row of paragraph_placeholder for each question, so questions can share a paragraph that is encoded once.
+        # Without it, every question has its own paragraph row
+        self.paragraph_index = tf.placeholder_with_default(tf.range(tf.shape(self.paragraph_placeholder)[0]), (None,), name="paragraph_index")
         self.question_length = tf.placeholder(tf.int32, (None), name="question_length")
         self.cell_initial_placeholder = tf.placeholder(tf.float32, (None, self.FLAGS.state_size), name="cell_init")
         #self.dropout_placeholder = tf.placeholder(tf.float32, (), name="dropout_placeholder")
@@ -293,21 +360,46 @@ class QASystem(object):
         tf.summary.scalar("global_norm", self.global_norm)
         self.train_op = optimizer.apply_gradients(zip(clipped_grads, variables), global_step = self.global_step, name = "apply_clipped_grads")
 
-        self.saver = tf.train.Saver(tf.global_variables())
+        self.saved_variables = [v for v in tf.global_variables() if v is not self.embeddings]
+        self.saver = tf.train.Saver(self.saved_variables)
+
+
+    def embedding_feed(self):
+        """
+        Feed for running self.embeddings.initializer (or the global initializer)
+        """
+        return {self.embedding_placeholder: self.pretrained_embeddings}
+
+
+    def initialize_embeddings(self, session):
+        """
+        Sets the embedding variable, which checkpoints do not hold
+        """
+        session.run(self.embeddings.initializer, self.embedding_feed())
 
 
     def setup_system(self):
-        Hr = self.encoder.encode(self.question_embedding, self.paragraph_embedding, self.question_length, self.paragraph_length)
+        # Each paragraph row is encoded once, then its HP is gathered for every question on it.
+        # Named, so inference can feed cached paragraph encodings instead (see paragraph_encodings)
+        HP = self.encoder.encode_paragraph(self.paragraph_embedding, self.paragraph_length)
+        self.HP = tf.identity(tf.gather(HP, self.paragraph_index), name = "HP")
+        question_paragraph_length = tf.gather(self.paragraph_length, self.paragraph_index)
+        Hr = self.encoder.encode(self.question_embedding, self.paragraph_embedding, self.question_length, question_paragraph_length,
+                                 paragraph_encoding = self.HP)
         self.pred_s, self.pred_e = self.decoder.decode(Hr, self.paragraph_mask_placeholder, self.cell_initial_placeholder)
         
 
     def setup_predictions(self):
         with vs.variable_scope("prediction"):
-            masked_pred_s = tf.boolean_mask(self.pred_s, self.paragraph_mask_placeholder)
-            masked_pred_e = tf.boolean_mask(self.pred_e, self.paragraph_mask_placeholder)
-
-            self.Beta_s = tf.nn.softmax(masked_pred_s)
-            self.Beta_e = tf.nn.softmax(masked_pred_e)
+            # One softmax per row of the [batch, P] logits, masked like the loss, so an example's
+            # distribution does not depend on the other examples of its batch
+            mask_term = (tf.cast(self.paragraph_mask_placeholder, tf.float32) - 1) * 1e30
+            masked_pred_s = self.pred_s + mask_term
+            masked_pred_e = self.pred_e + mask_term
+
+            # Named, so export_model.py and FrozenQASystem can find them in a frozen graph
+            self.Beta_s = tf.identity(tf.nn.softmax(masked_pred_s), name = "Beta_s")
+            self.Beta_e = tf.identity(tf.nn.softmax(masked_pred_e), name = "Beta_e")
             beta_summaries(self.Beta_s, "Beta_S")
             beta_summaries(self.Beta_e, "Beta_E")
 
@@ -315,17 +407,14 @@ class QASystem(object):
 
     def setup_loss(self):
         with vs.variable_scope("loss"):
-            start_predictions = tf.unstack(self.pred_s, self.FLAGS.batch_size)
-            end_predictions = tf.unstack(self.pred_e, self.FLAGS.batch_size)
-            masks = tf.unstack(self.paragraph_mask_placeholder, self.FLAGS.batch_size)
-
-            masked_preds_s = [tf.boolean_mask(p, mask) for p, mask in zip(start_predictions, masks)]
-            masked_preds_e = [tf.boolean_mask(p, mask) for p, mask in zip(end_predictions, masks)]
-
-            loss_list_1 = [tf.nn.sparse_softmax_cross_entropy_with_logits(masked_preds_s[i], self.start_answer_placeholder[i]) for i in range(len(masked_preds_s))]
-            loss_list_2 = [tf.nn.sparse_softmax_cross_entropy_with_logits(masked_preds_e[i], self.end_answer_placeholder[i]) for i in range(len(masked_preds_e))]
-            l1 = tf.reduce_mean(loss_list_1)
-            l2 = tf.reduce_mean(loss_list_2)
+            # One cross-entropy over the whole [batch, P] logits, with huge negative logits on
+            # padding so it gets no probability; this works for any batch size
+            mask_term = (tf.cast(self.paragraph_mask_placeholder, tf.float32) - 1) * 1e30
+            masked_preds_s = self.pred_s + mask_term
+            masked_preds_e = self.pred_e + mask_term
+
+            l1 = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(masked_preds_s, self.start_answer_placeholder))
+            l2 = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(masked_preds_e, self.end_answer_placeholder))
             self.loss = l1 + l2
             tf.summary.scalar('loss', self.loss)
         
@@ -333,28 +422,74 @@ class QASystem(object):
     def setup_embeddings(self):
         """
         Loads distributed word representations based on placeholder tokens
+
+        The embeddings are not trained, so they are left out of self.saver: the variable is set
+        from the memory-mapped float32 file through a placeholder (see embedding_feed) instead
         """
         with vs.variable_scope("embeddings"):
-            embed_file = np.load(self.FLAGS.embed_path)
-            pretrained_embeddings = embed_file['glove']
-            embeddings = tf.Variable(pretrained_embeddings, name = "embeddings", dtype=tf.float32, trainable = False)
+            self.pretrained_embeddings = load_embeddings(self.FLAGS.embed_path)
+            self.embedding_placeholder = tf.placeholder(tf.float32, self.pretrained_embeddings.shape, name = "embedding_init")
+            self.embeddings = tf.Variable(self.embedding_placeholder, name = "embeddings", trainable = False)
+            embeddings = self.embeddings
+            if self.extra_embeddings is not None and len(self.extra_embeddings):
+                embeddings = tf.concat(0, [embeddings, tf.constant(self.extra_embeddings, dtype=tf.float32)])
             self.paragraph_embedding = tf.nn.embedding_lookup(embeddings,self.paragraph_placeholder)
             self.question_embedding = tf.nn.embedding_lookup(embeddings,self.question_placeholder)
 
 
-    def decode(self, session, qs, ps, q_masks, p_masks):  #Currently still decodes one at a time
+    def paragraph_encodings(self, session, ps, lengths, paragraph_cache):
+        """
+        HP of a batch of paragraphs ([batch, longest, state_size], zero past each length like
+        the paragraph LSTM's own output), running the LSTM only for paragraphs missing from
+        paragraph_cache, each once
+        """
+        keys = [paragraph_cache.key(p[:n]) for p, n in zip(ps, lengths)]
+        encodings = {}
+        missing = []
+        for i, key in enumerate(keys):
+            if key in encodings:
+                continue
+            if key in paragraph_cache:
+                encodings[key] = paragraph_cache.get(key)
+            else:
+                encodings[key] = None
+                missing.append(i)
+
+        if missing:
+            longest = max(int(np.max(lengths[missing])), 1)
+            HP = session.run(self.HP, {self.paragraph_placeholder: ps[missing, :longest], self.paragraph_length: lengths[missing]})
+            for row, i in enumerate(missing):
+                encodings[keys[i]] = HP[row, :lengths[i]].copy()     # A view would keep the whole batch alive in the cache
+                paragraph_cache.put(keys[i], encodings[keys[i]])
+        paragraph_cache.add(lengths, lengths[missing])
+
+        HP = np.zeros((len(ps), ps.shape[1], self.FLAGS.state_size), dtype = np.float32)
+        for row, key in enumerate(keys):
+            HP[row, :len(encodings[key])] = encodings[key]
+        return HP
+
+
+    def decode(self, session, qs, ps, q_masks, p_masks, paragraph_cache=None):
         """
         Returns the probability distribution over different positions in the paragraph
         so that other methods like self.answer() will be able to work properly
+
+        With a ParagraphCache, paragraphs encoded before are not run through the paragraph LSTM again
         """
         input_feed = {}
 
-        input_feed[self.question_placeholder] = np.array(list(qs))
-        input_feed[self.paragraph_placeholder] = np.array(list(ps))
-        input_feed[self.paragraph_mask_placeholder] = np.array(list(p_masks))
-        input_feed[self.paragraph_length] = np.sum(list(p_masks), axis = 1)   # Sum and make into a list
-        input_feed[self.question_length] = np.sum(list(q_masks), axis = 1)    # Sum and make into a list
-        input_feed[self.cell_initial_placeholder] = np.zeros((1, self.FLAGS.state_size))
+        qs, q_masks = trim_to_longest(qs, q_masks)
+        ps, p_masks = trim_to_longest(ps, p_masks)
+        p_lengths = np.sum(p_masks, axis = 1)
+
+        input_feed[self.question_placeholder] = qs
+        input_feed[self.paragraph_placeholder] = ps
+        input_feed[self.paragraph_mask_placeholder] = p_masks
+        input_feed[self.paragraph_length] = p_lengths   # Sum and make into a list
+        input_feed[self.question_length] = np.sum(q_masks, axis = 1)    # Sum and make into a list
+        input_feed[self.cell_initial_placeholder] = np.zeros((len(ps), self.FLAGS.state_size))
+        if paragraph_cache is not None:
+            input_feed[self.HP] = self.paragraph_encodings(session, ps, p_lengths, paragraph_cache)
 
         output_feed = [self.Beta_s, self.Beta_e]    # Get the softmaxed outputs
 
@@ -363,98 +498,150 @@ class QASystem(object):
         return outputs
 
 
-    def answer(self, session, question, paragraph, question_mask, paragraph_mask):
+    def span_probabilities(self, session, questions, paragraphs, q_masks, p_masks, batch_size=100, paragraph_cache=None):
+        """
+        Runs the examples through the graph batch_size at a time and yields per batch
+        the [batch, P] start and end distributions and the paragraph lengths
+        """
+        for i in xrange(0, len(questions), batch_size):
+            batch_p_masks = p_masks[i : i + batch_size]
+            B_s, B_e = self.decode(session, questions[i : i + batch_size], paragraphs[i : i + batch_size], q_masks[i : i + batch_size], batch_p_masks,
+                                   paragraph_cache = paragraph_cache)
+            lengths = np.sum(list(batch_p_masks), axis = 1)
+            yield B_s, B_e, lengths
+
 
-        B_s, B_e = self.decode(session, [question], [paragraph], [question_mask], [paragraph_mask])
+    def answer_batch(self, session, questions, paragraphs, q_masks, p_masks, batch_size=100, paragraph_cache=None):
+        """
+        Answers many questions with one session.run per batch_size examples, picking the
+        best span no longer than FLAGS.max_answer_length
 
-        a_s = np.argmax(B_s)
-        a_e = np.argmax(B_e)
+        :param paragraph_cache: optional ParagraphCache, to encode each paragraph only once
+        :return: list of (a_s, a_e) spans in the same order as the inputs
+        """
+        starts, ends = [], []
+        for B_s, B_e, lengths in self.span_probabilities(session, questions, paragraphs, q_masks, p_masks, batch_size, paragraph_cache):
+            a_s, a_e, _ = best_spans(B_s, B_e, self.FLAGS.max_answer_length, lengths)
+            starts.extend(a_s)
+            ends.extend(a_e)
 
-        #Force a_e to be after a_s.
-        if a_e < a_s:
-            if np.max(B_s) > np.max(B_e):   #Move a_e to a_s b/c a_s has a higher probability
-                a_e = a_s
-            else:                           #Move a_s to a_e b/c a_e has a higher probability
-                a_s = a_e
+        return list(zip(starts, ends))
 
-        return a_s, a_e
 
+    def nbest_batch(self, session, questions, paragraphs, q_masks, p_masks, k=5, batch_size=100, paragraph_cache=None):
+        """
+        Like answer_batch, but keeps the k best spans of each example
 
-    def evaluate_answer(self, session, dataset, rev_vocab, sample=100, log=False):
+        :return: list with one [(a_s, a_e, score), ...] list per example, best first
+        """
+        nbest = []
+        for B_s, B_e, lengths in self.span_probabilities(session, questions, paragraphs, q_masks, p_masks, batch_size, paragraph_cache):
+            a_s, a_e, scores = nbest_spans(B_s, B_e, k, self.FLAGS.max_answer_length, lengths)
+            nbest.extend([list(zip(*spans)) for spans in zip(a_s, a_e, scores)])
+
+        return nbest
+
+
+    def answer(self, session, question, paragraph, question_mask, paragraph_mask):
+
+        return self.answer_batch(session, [question], [paragraph], [question_mask], [paragraph_mask])[0]
+
+
+    def evaluate_answer(self, session, dataset, rev_vocab, sample=100, log=False, evaluator=None):
         """
         Evaluate the model's performance using the harmonic mean of F1 and Exact Match (EM)
         with the set of true answer labels
 
-        This step actually takes quite some time. So we can only sample 100 examples
-        from either training or testing set.
-
         :param session: session should always be centrally managed in train.py
-        :param dataset: a representation of our data, in some implementations, you can
-                        pass in multiple components (arguments) of one dataset to this function
-        :param sample: how many examples in dataset we look at
+        :param dataset: a Dataset
+        :param sample: how many examples in dataset we look at (None: all of them, in order)
         :param log: whether we print to std out stream
+        :param evaluator: FastEvaluator built from dataset_evaluator(dataset), to not normalize
+                          the ground truths again on every call (default: built for the sample)
         :return:
         """
         
+        if sample is None or sample >= len(dataset):
+            sample = len(dataset)
+            indices = np.arange(sample)
+        else:
+            indices = np.array(random.sample(xrange(len(dataset)), sample))
+        examples = dataset.gather(indices)
+        paragraphs = examples.paragraphs
+        pred_spans = self.answer_batch(session, examples.questions, paragraphs, examples.question_mask(), examples.paragraph_mask())
+
         our_answers = []
-        their_answers = []
-        for question, question_mask, paragraph, paragraph_mask, span, true_answer in random.sample(dataset, sample):
-            a_s, a_e = self.answer(session, question, paragraph, question_mask, paragraph_mask)
+        for paragraph, (a_s, a_e) in zip(paragraphs, pred_spans):
             token_answer = paragraph[a_s : a_e + 1]      #The slice of the context paragraph that is our answer
+            our_answers.append(' '.join(rev_vocab[token] for token in token_answer))
 
-            sentence = []
-            for token in token_answer:
-                word = rev_vocab[token]
-                sentence.append(word)
-
-            our_answer = ' '.join(word for word in sentence)
-            our_answers.append(our_answer)
-            their_answer = ' '.join(word for word in true_answer)
-            their_answers.append(their_answer)
-
-        f1 = exact_match = total = 0
-        answer_tuples = zip(their_answers, our_answers)
-        for ground_truth, prediction in answer_tuples:
-            total += 1
-            exact_match += exact_match_score(prediction, ground_truth)
-            f1 += f1_score(prediction, ground_truth)
-
-        exact_match = 100.0 * exact_match / total
-        f1 = 100.0 * f1 / total
+        if evaluator is None:
+            evaluator, indices = self.dataset_evaluator(examples), None
+        exact_match, f1 = evaluator.score(our_answers, indices)
 
         if log:
             logging.info("F1: {}, EM: {}, for {} samples".format(f1, exact_match, sample))
             logging.info("Samples:")
-            for i in xrange(min(10, sample)):
-                ground_truth, our_answer = answer_tuples[i]
-                logging.info("Ground Truth: {}, Our Answer: {}".format(ground_truth, our_answer))
+            for our_answer, true_answer in zip(our_answers[:10], examples.gather(np.arange(min(10, sample))).answers()):
+                logging.info("Ground Truth: {}, Our Answer: {}".format(' '.join(true_answer), our_answer))
 
         return f1, exact_match
     
 
+    def dataset_evaluator(self, dataset):
+        """
+        FastEvaluator for the (token) answers of a Dataset, in its order
+        """
+        return FastEvaluator([[' '.join(answer)] for answer in dataset.answers()])
+
+
+    def prepare_feed(self, batch):
+        """
+        Turns a batch from get_batch into the feed dict for optimize_feed. Only numpy work,
+        so a BatchPrefetcher can run it on another thread while the graph runs.
+        The batch's unique paragraphs are fed once each, with paragraph_index pointing every
+        question to its own, so the graph runs the paragraph LSTM once per paragraph
+        """
+        input_feed = {}
+
+        # Pad the batch only to its own longest question and paragraph
+        longest_question = max(int(np.max(batch.question_lengths)), 1)
+        paragraph_lengths = batch.paragraph_lengths
+        longest_paragraph = max(int(np.max(paragraph_lengths)), 1)
+
+        input_feed[self.question_placeholder] = batch.questions[:, :longest_question]
+        input_feed[self.paragraph_placeholder] = batch.contexts[:, :longest_paragraph]
+        input_feed[self.paragraph_length] = batch.context_lengths
+        input_feed[self.paragraph_index] = batch.context_ids
+        input_feed[self.start_answer_placeholder] = batch.spans[:, 0]
+        input_feed[self.end_answer_placeholder] = batch.spans[:, 1]
+        input_feed[self.paragraph_mask_placeholder] = mask_from_lengths(paragraph_lengths, longest_paragraph)
+        input_feed[self.question_length] = batch.question_lengths
+        #input_feed[self.dropout_placeholder] = self.FLAGS.dropout
+
+        # Never written to, so one zero state per batch size is shared by all steps
+        batch_size = len(batch)
+        if batch_size not in self.cell_init_zeros:
+            self.cell_init_zeros[batch_size] = np.zeros((batch_size, self.FLAGS.state_size), dtype = np.float32)
+        input_feed[self.cell_initial_placeholder] = self.cell_init_zeros[batch_size]
+
+        return input_feed
+
+
     def optimize(self, session, batch):
         """
         Takes in actual data to optimize your model
         This method is equivalent to a step() function
         :return:
         """
-        train_qs, train_q_masks, train_ps, train_p_masks, train_spans, train_answers = zip(*batch)    # Unzip batch, each returned element is a tuple of lists
+        return self.optimize_feed(session, self.prepare_feed(batch))
 
-        input_feed = {}
-
-        start_answers = [train_span[0] for train_span in list(train_spans)]
-        end_answers = [train_span[1] for train_span in list(train_spans)]
-
-        input_feed[self.question_placeholder] = np.array(list(train_qs))
-        input_feed[self.paragraph_placeholder] = np.array(list(train_ps))
-        input_feed[self.start_answer_placeholder] = np.array(start_answers)
-        input_feed[self.end_answer_placeholder] = np.array(end_answers)
-        input_feed[self.paragraph_mask_placeholder] = np.array(list(train_p_masks))
-        input_feed[self.paragraph_length] = np.sum(list(train_p_masks), axis = 1)   # Sum and make into a list
-        input_feed[self.question_length] = np.sum(list(train_q_masks), axis = 1)    # Sum and make into a list
-        #input_feed[self.dropout_placeholder] = self.FLAGS.dropout
-        input_feed[self.cell_initial_placeholder] = np.zeros((self.FLAGS.batch_size, self.FLAGS.state_size))
 
+    def optimize_feed(self, session, input_feed):
+        """
+        One training step on a feed dict from prepare_feed
+        :return: loss, gradient norm and global step
+        """
         output_feed = []
 
         output_feed.append(self.train_op)
@@ -472,13 +659,11 @@ class QASystem(object):
 
         return loss, norm, step
 
-    def get_batch(self, dataset):
-        batch = random.sample(dataset, self.FLAGS.batch_size)
-        for i, (q, q_mask, p, p_mask, span, answ) in enumerate(batch):
-            while span[1] >= 300:    # Simply dont process any questions with answers outside of the possible range
-                (q, q_mask, p, p_mask, span, answ) = random.choice(dataset)
-                batch[i] = (q, q_mask, p, p_mask, span, answ)
-        return batch
+    def get_batch(self, dataset, indices):
+        """
+        Gathers the examples at indices (an array from a sampler) out of a Dataset
+        """
+        return dataset.gather(indices)
 
 
     def train(self, session, dataset, train_dir, rev_vocab):
@@ -499,8 +684,7 @@ class QASystem(object):
         looking at the cost.
 
         :param session: it should be passed in from train.py
-        :param dataset: a representation of our data, in some implementations, you can
-                        pass in multiple components (arguments) of one dataset to this function
+        :param dataset: dict of "train" and "val" Datasets, from utils.get_dataset
         :param train_dir: path to the directory where you should save the model checkpoint
         :return:
         """
@@ -516,54 +700,112 @@ class QASystem(object):
         logging.info("Number of params: %d (retreival took %f secs)" % (num_params, toc - tic))
 
         #Info for saving models
-        saver = tf.train.Saver()
         start_time = "{:%d-%m-%Y_%H:%M:%S}".format(datetime.now())
         model_name = "match-lstm"
         checkpoint_path = os.path.join(train_dir, model_name, start_time)
         early_stopping_path = os.path.join(checkpoint_path, "early_stopping")
-
-        train_data = zip(dataset["train_questions"], dataset["train_questions_mask"], dataset["train_context"], dataset["train_context_mask"], dataset["train_span"], dataset["train_answer"])
-        dev_data = zip(dataset["val_questions"], dataset["val_questions_mask"], dataset["val_context"], dataset["val_context_mask"], dataset["val_span"], dataset["val_answer"])
-
-        num_data = len(train_data)
-
-        best_f1 = 0
+        checkpoints = CheckpointWriter(self.saved_variables, checkpoint_path, early_stopping_path, keep = self.FLAGS.keep, keep_best = self.FLAGS.keep_best)
+
+        train_data, dev_data = dataset["train"], dataset["val"]
+        dev_evaluator = self.dataset_evaluator(dev_data)     # Ground truths normalized once for all epochs
+
+        # Filter once: answers outside of the possible range can not be learned
+        valid = np.flatnonzero(train_data.spans[:, 1] < self.FLAGS.max_paragraph_size)
+        num_data = len(valid)
+        logging.info("Training on %d of %d examples (the others end past max_paragraph_size)" % (num_data, len(train_data)))
+
+        # A seed of 0 gives a new batch order every run
+        seed = self.FLAGS.seed or None
+        if self.FLAGS.share_paragraphs:
+            # Questions about the same paragraph in the same batches (of similar paragraph lengths with --bucket)
+            sampler = ParagraphSampler(train_data.context_ids, self.FLAGS.batch_size, indices = valid,
+                                       lengths = train_data.paragraph_lengths if self.FLAGS.bucket else None,
+                                       last_batch = self.FLAGS.last_batch, seed = seed)
+        elif self.FLAGS.bucket:
+            # Group examples with similar paragraph lengths
+            sampler = BucketSampler(train_data.paragraph_lengths, self.FLAGS.batch_size, indices = valid,
+                                    last_batch = self.FLAGS.last_batch, seed = seed)
+        else:
+            sampler = EpochSampler(valid, self.FLAGS.batch_size, last_batch = self.FLAGS.last_batch, seed = seed)
 
         # Normal training loop
         rolling_ave_window = 20
         losses = [0]*rolling_ave_window
         for cur_epoch in range(self.FLAGS.epochs):
-            for i in range(int(math.ceil(num_data/self.FLAGS.batch_size))):
-                batch = self.get_batch(train_data)
-
-                loss, norm, step = self.optimize(session, batch)
+            batches = (self.get_batch(train_data, indices) for indices in sampler)
+
+            padding = PaddingReport(self.FLAGS.max_question_size, self.FLAGS.max_paragraph_size)
+            num_seen, num_steps, num_paragraphs = 0, 0, 0
+            graph_time = 0.0
+            if self.FLAGS.prefetch > 0:
+                # Feed dicts are built on a background thread while session.run works on the last one
+                prepared = BatchPrefetcher(batches, self.prepare_feed, capacity = self.FLAGS.prefetch)
+            else:
+                prepared = ((batch, self.prepare_feed(batch)) for batch in batches)
+            epoch_tic = time.time()
+            for batch, input_feed in prepared:
+                padding.add(input_feed[self.question_length], input_feed[self.paragraph_length][input_feed[self.paragraph_index]])
+                num_paragraphs += len(input_feed[self.paragraph_length])
+
+                tic = time.time()
+                loss, norm, step = self.optimize_feed(session, input_feed)
+                graph_time += time.time() - tic
                 losses[step % rolling_ave_window] = loss
 
+                if self.FLAGS.save_every > 0 and step % self.FLAGS.save_every == 0:
+                    checkpoints.save(session, step)
+
                 mean_loss = np.mean(losses)
-                num_complete = int(20*(self.FLAGS.batch_size*float(i+1)/num_data))
+                num_seen += len(batch)
+                num_steps += 1
+                num_complete = int(20*(float(num_seen)/num_data))
                 sys.stdout.write('\r')
-                sys.stdout.write("EPOCH: %d ==> (Rolling Ave Loss: %.3f, Batch Loss: %.3f) [%-20s] (Completion:%d/%d) [norm: %.2f]" % (cur_epoch + 1, mean_loss, loss, '='*num_complete, (i+1)*self.FLAGS.batch_size, num_data, norm))
+                sys.stdout.write("EPOCH: %d ==> (Rolling Ave Loss: %.3f, Batch Loss: %.3f) [%-20s] (Completion:%d/%d) [norm: %.2f]" % (cur_epoch + 1, mean_loss, loss, '='*num_complete, num_seen, num_data, norm))
                 sys.stdout.flush()
 
+            # Without prefetching, preparing the feeds is part of the time outside of session.run
+            epoch_time = time.time() - epoch_tic
+            data_time = prepared.wait_time if self.FLAGS.prefetch > 0 else epoch_time - graph_time
             sys.stdout.write('\n')
-            
+            logging.info("Trained on %d questions in %.1f secs (%.1f questions/sec), encoding %d paragraphs (%.2f per question)" % (
+                num_seen, epoch_time, num_seen / max(epoch_time, 1e-9), num_paragraphs, num_paragraphs / max(num_seen, 1)))
+            logging.info("Per step: %.1f ms waiting for data, %.1f ms in session.run (%d steps)" % (
+                1000 * data_time / max(num_steps, 1), 1000 * graph_time / max(num_steps, 1), num_steps))
+            logging.info(padding.summary())
+
             logging.info("---------- Evaluating on Train Set ----------")
             self.evaluate_answer(session, train_data, rev_vocab, sample=self.FLAGS.eval_size, log=True)
             logging.info("---------- Evaluating on Dev Set ------------")
-            f1, em = self.evaluate_answer(session, dev_data, rev_vocab, sample=self.FLAGS.eval_size, log=True)
+            tic = time.time()
+            f1, em = self.evaluate_answer(session, dev_data, rev_vocab, sample=None, log=True, evaluator=dev_evaluator)
+            logging.info("Evaluated the whole dev set in %.1f secs" % (time.time() - tic))
 
-            #Save model after each epoch
-            if not os.path.exists(checkpoint_path):
-                os.makedirs(checkpoint_path)
-            save_path = saver.save(session, os.path.join(checkpoint_path, "model.ckpt"), step)
-            print("Model checkpoint saved in file: %s" % save_path)
+            # Save model after each epoch, and as a best model (early stopping) when its F1 is among the keep_best highest
+            blocked = checkpoints.save(session, step, score = f1)
+            logging.info("Checkpoint snapshot of step %d took %.3f secs of training time" % (step, blocked))
 
-            # Save best model based on F1 (Early Stopping)
-            if f1 > best_f1:
-                best_f1 = f1
-                if not os.path.exists(early_stopping_path):
-                    os.makedirs(early_stopping_path)
-                save_path = saver.save(session, os.path.join(early_stopping_path, "best_model.ckpt"))
-                print("New Best F1 Score: %f !!! Best Model saved in file: %s" % (best_f1, save_path))
+        checkpoints.wait()
+
+
+class FrozenQASystem(QASystem):
+    """
+    Inference-only QASystem read from a GraphDef written by export_model.py: the weights and
+    embeddings are constants and there are no training ops, so nothing has to be built or restored.
+    decode, answer_batch and the other inference methods work as in QASystem.
+    """
+    INPUT_NAMES = ["question_placeholder", "paragraph_placeholder", "paragraph_mask_placeholder",
+                   "question_length", "paragraph_length", "cell_init", "qa/HP"]
+    OUTPUT_NAMES = ["qa/prediction/Beta_s", "qa/prediction/Beta_e"]
+
+    def __init__(self, frozen_graph_path, FLAGS):
+        self.FLAGS = FLAGS
 
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(frozen_graph_path, "rb") as f:
+            graph_def.ParseFromString(f.read())
 
+        tensors = tf.import_graph_def(graph_def, return_elements = [name + ":0" for name in self.INPUT_NAMES + self.OUTPUT_NAMES], name = "")
+        (self.question_placeholder, self.paragraph_placeholder, self.paragraph_mask_placeholder,
+         self.question_length, self.paragraph_length, self.cell_initial_placeholder, self.HP, self.Beta_s, self.Beta_e) = tensors
+        if self.Beta_s.get_shape().ndims == 1:
+            raise ValueError("%s has flattened predictions from an older export_model.py, export it again" % frozen_graph_path)
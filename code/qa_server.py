@@ -0,0 +1,268 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import sys
+import time
+import threading
+from collections import deque
+
+import numpy as np
+import six
+from six.moves import queue, socketserver, BaseHTTPServer
+import tensorflow as tf
+
+import qa_data
+from paragraph_cache import ParagraphCache
+from preprocessing.squad_preprocess import tokenize
+from utils import initialize_vocab, pad_inputs
+from qa_answer import FLAGS, tokenize_context, span_text, build_model, restore_model
+
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+# The model flags are qa_answer.py's
+tf.app.flags.DEFINE_string("host", "127.0.0.1", "Address to serve on (default: local connections only).")
+tf.app.flags.DEFINE_integer("port", 8000, "Port to serve on.")
+tf.app.flags.DEFINE_integer("max_batch_size", 32, "Most questions answered by one session.run.")
+tf.app.flags.DEFINE_float("max_wait_ms", 5.0, "Longest a question waits for others to fill its batch before it is run anyway.")
+tf.app.flags.DEFINE_integer("metrics_window", 10000, "Latest requests the latency percentiles are computed over.")
+
+
+class ServingStats(object):
+    """
+    Request latencies (of the last window requests) and batch sizes, for /metrics
+    """
+    def __init__(self, max_batch_size, window=10000):
+        self.max_batch_size = max_batch_size
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen = window)
+        self.queue_waits = deque(maxlen = window)
+        self.batch_sizes = np.zeros(max_batch_size + 1, dtype = np.int64)
+        self.requests = 0
+        self.errors = 0
+        self.start_time = time.time()
+
+    def add_request(self, latency, queue_wait=None, error=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.latencies.append(latency)
+            if queue_wait is not None:
+                self.queue_waits.append(queue_wait)
+
+    def add_batch(self, size):
+        with self.lock:
+            self.batch_sizes[size] += 1
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            queue_waits = np.array(self.queue_waits) * 1000
+            batch_sizes = self.batch_sizes.copy()
+            requests, errors = self.requests, self.errors
+        batches = int(np.sum(batch_sizes))
+        batched = int(np.dot(batch_sizes, np.arange(len(batch_sizes))))
+
+        def percentiles(values):
+            if not len(values):
+                return None
+            return dict(("p%d" % p, float(np.percentile(values, p))) for p in [50, 95, 99])
+
+        return {"requests": requests, "errors": errors, "uptime_secs": time.time() - self.start_time,
+                "latency_ms": percentiles(latencies), "queue_wait_ms": percentiles(queue_waits),
+                "batches": batches, "max_batch_size": self.max_batch_size,
+                "mean_batch_size": batched / max(batches, 1),
+                "batch_fill": batched / max(batches * self.max_batch_size, 1),
+                "batch_size_counts": dict((str(size), int(count)) for size, count in enumerate(batch_sizes) if count)}
+
+
+class MicroBatcher(object):
+    """
+    Collects concurrently submitted items into batches for one run_batch call each, on a
+    single worker thread (the only one that uses the session).
+
+    A batch starts with the oldest waiting item and closes when it holds max_batch_size items
+    or max_wait seconds after that item arrived, whichever comes first. submit() blocks until
+    its item's result is back and returns it, or raises what run_batch raised.
+    """
+    def __init__(self, run_batch, max_batch_size, max_wait, stats=None):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = stats
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target = self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, item):
+        """
+        :return: (result, seconds the item waited for its batch to start)
+        """
+        pending = {"item": item, "arrival": time.time(), "done": threading.Event()}
+        self.queue.put(pending)
+        pending["done"].wait()
+        if "error" in pending:
+            six.reraise(*pending["error"])
+        return pending["result"], pending["started"] - pending["arrival"]
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = batch[0]["arrival"] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                batch.append(self.queue.get(timeout = timeout) if timeout > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _serve(self):
+        while True:
+            batch = self._next_batch()
+            started = time.time()
+            if self.stats is not None:
+                self.stats.add_batch(len(batch))
+            try:
+                results = self.run_batch([pending["item"] for pending in batch])
+                for pending, result in zip(batch, results):
+                    pending["result"] = result
+            except Exception:
+                logging.exception("Batch of %d failed" % len(batch))
+                error = sys.exc_info()
+                for pending in batch:
+                    pending["error"] = error
+            for pending in batch:
+                pending["started"] = started
+                pending["done"].set()
+
+
+class AnswerService(object):
+    """
+    Answers (context, question) pairs with a restored QASystem, batching concurrent requests
+    """
+    def __init__(self, sess, model, vocab, rev_vocab, stats):
+        self.sess = sess
+        self.model = model
+        self.vocab = vocab
+        self.rev_vocab = rev_vocab
+        self.stats = stats
+        self.paragraph_cache = ParagraphCache(FLAGS.paragraph_cache) if FLAGS.paragraph_cache > 0 else None
+        self.batcher = MicroBatcher(self.answer_batch, FLAGS.max_batch_size, FLAGS.max_wait_ms / 1000, stats)
+
+    def answer_batch(self, items):
+        """
+        :param items: (question ids, paragraph ids) pairs
+        :return: the (a_s, a_e) span of each
+        """
+        questions, paragraphs = zip(*items)
+        questions_padded, questions_masked = pad_inputs(questions, FLAGS.max_question_size)
+        paragraphs_padded, paragraphs_masked = pad_inputs(paragraphs, FLAGS.max_paragraph_size)
+        return self.model.answer_batch(self.sess, questions_padded, paragraphs_padded, questions_masked, paragraphs_masked,
+                                       batch_size = len(items), paragraph_cache = self.paragraph_cache)
+
+    def answer(self, context, question):
+        """
+        Tokenizes in the calling (request) thread, so only the graph work is serialized
+        """
+        context_tokens, context_offsets = tokenize_context(context)
+        paragraph = [self.vocab.get(w, qa_data.UNK_ID) for w in context_tokens]
+        question_ids = [self.vocab.get(w, qa_data.UNK_ID) for w in tokenize(question)]
+        if not paragraph or not question_ids:
+            raise ValueError("Empty context or question")
+
+        span, queue_wait = self.batcher.submit((question_ids, paragraph))
+        return span_text(paragraph, span, context, context_offsets, self.rev_vocab), span, queue_wait
+
+
+class AnswerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    POST /answer {"context": ..., "question": ...} -> {"answer": ..., "span": [a_s, a_e]}
+    GET /metrics -> ServingStats summary
+    """
+    protocol_version = "HTTP/1.1"     # Keep-alive, so load generators do not pay a connection per request
+    # The status line, headers and body go out as separate writes; with Nagle on, the client's
+    # delayed ACK would hold the body back ~40 ms
+    disable_nagle_algorithm = True
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.send_json(200, self.server.service.stats.summary())
+        else:
+            self.send_json(404, {"error": "Unknown path %s" % self.path})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path != "/answer":
+            self.send_json(404, {"error": "Unknown path %s" % self.path})
+            return
+
+        tic = time.time()
+        try:
+            request = json.loads(body.decode("utf-8"))
+            context, question = request["context"], request["question"]
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {"error": "Expected a JSON object with context and question: %s" % e})
+            return
+
+        service = self.server.service
+        try:
+            answer, span, queue_wait = service.answer(context, question)
+        except ValueError as e:
+            service.stats.add_request(time.time() - tic, error = True)
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            service.stats.add_request(time.time() - tic, error = True)
+            self.send_json(500, {"error": str(e)})
+            return
+        service.stats.add_request(time.time() - tic, queue_wait)
+        self.send_json(200, {"answer": answer, "span": [int(span[0]), int(span[1])]})
+
+    def log_message(self, format, *args):
+        pass    # One line per request would cost more than answering it
+
+
+class AnswerServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, AnswerHandler)
+        self.service = service
+
+
+def main(_):
+    vocab, rev_vocab = initialize_vocab(FLAGS.vocab_path)
+    FLAGS.embed_path = FLAGS.embed_path or "data/squad/glove.trimmed.{}.npz".format(FLAGS.embedding_size)
+
+    tic = time.time()
+    qa = build_model()
+    with tf.Session() as sess:
+        restore_model(sess, qa)
+        stats = ServingStats(FLAGS.max_batch_size, FLAGS.metrics_window)
+        service = AnswerService(sess, qa, vocab, rev_vocab, stats)
+        server = AnswerServer((FLAGS.host, FLAGS.port), service)
+        logging.info("Model loaded in %.2f secs (%s); serving on http://%s:%d (max batch %d, max wait %.1f ms)" % (
+            time.time() - tic, FLAGS.frozen_graph or "checkpoint", FLAGS.host, FLAGS.port, FLAGS.max_batch_size, FLAGS.max_wait_ms))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            logging.info("Served: %s" % json.dumps(stats.summary()))
+
+
+if __name__ == "__main__":
+    tf.app.run()
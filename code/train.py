@@ -4,6 +4,7 @@ from __future__ import print_function
 
 import os
 import json
+import resource
 
 import tensorflow as tf
 
@@ -24,7 +25,8 @@ tf.app.flags.DEFINE_integer("state_size", 150, "Size of each model layer. Defaul
 tf.app.flags.DEFINE_integer("embedding_size", 300, "Size of the pretrained embeddings. 300 is the max size available for GloVe")    # Previously, 100
 tf.app.flags.DEFINE_integer("max_paragraph_size", 300, "The length to cut paragraphs off at")   # As per Frank's histogram
 tf.app.flags.DEFINE_integer("max_question_size", 20, "The length to cut question off at")   # As per Frank's histogram
-tf.app.flags.DEFINE_integer("eval_size", 400, "The number of examples to evaluate F1 and EM on.")
+tf.app.flags.DEFINE_integer("max_answer_length", 15, "Longest answer span (end - start) to consider when decoding.")
+tf.app.flags.DEFINE_integer("eval_size", 400, "The number of train examples to evaluate F1 and EM on after each epoch (the dev set is evaluated in full).")
 tf.app.flags.DEFINE_string("data_dir", "data/squad", "SQuAD directory (default ./data/squad)")
 tf.app.flags.DEFINE_string("train_dir", "train", "Training directory to save the model parameters (default: ./train).")
 tf.app.flags.DEFINE_string("load_train_dir", "", "Training directory to load model parameters from to resume training (default: {train_dir}).")
@@ -32,9 +34,17 @@ tf.app.flags.DEFINE_string("log_dir", "log", "Path to store log and flag files (
 tf.app.flags.DEFINE_string("optimizer", "adam", "adam / sgd")
 tf.app.flags.DEFINE_string("vocab_path", "data/squad/vocab.dat", "Path to vocab file (default: ./data/squad/vocab.dat)")
 tf.app.flags.DEFINE_string("embed_path", "", "Path to the trimmed GLoVe embedding (default: ./data/squad/glove.trimmed.{embedding_size}.npz)")
+tf.app.flags.DEFINE_integer("keep", 5, "How many of the newest checkpoints to keep, 0 indicates keep all.")
+tf.app.flags.DEFINE_integer("keep_best", 1, "How many of the highest dev F1 checkpoints to keep in early_stopping/.")
+tf.app.flags.DEFINE_integer("save_every", 0, "Also save a checkpoint every this many training steps, 0 indicates only after each epoch.")
 tf.app.flags.DEFINE_bool("tb", False, "Log Tensorboard Graph")
+tf.app.flags.DEFINE_bool("fast_match_lstm", True, "Project the paragraph for the Match-LSTM once outside the recurrence (same weights and outputs).")
+tf.app.flags.DEFINE_integer("prefetch", 4, "Batches to prepare ahead on a background thread, 0 prepares each batch on the training thread.")
+tf.app.flags.DEFINE_bool("bucket", True, "Batch examples of similar paragraph length together (--nobucket samples batches at random).")
+tf.app.flags.DEFINE_integer("seed", 0, "Seed for the order of the training batches, 0 picks a new order every run.")
+tf.app.flags.DEFINE_string("last_batch", "keep", "What to do with the short last batch of an epoch: keep, drop, or pad it with examples from the start of the epoch.")
+tf.app.flags.DEFINE_bool("share_paragraphs", False, "Batch questions about the same paragraph together, so each batch encodes fewer paragraphs (still by paragraph length with --bucket).")
 
-#tf.app.flags.DEFINE_integer("keep", 0, "How many checkpoints to keep, 0 indicates keep all.")
 #tf.app.flags.DEFINE_integer("output_size", 750, "The output size of your model.")
 #tf.app.flags.DEFINE_integer("print_every", 1, "How many iterations to do per print.")
 #tf.app.flags.DEFINE_bool("verbose", False, "")
@@ -46,6 +56,10 @@ def main(_):
 
     # Do what you need to load datasets from FLAGS.data_dir
     dataset = get_dataset(FLAGS.data_dir, FLAGS.max_question_size, FLAGS.max_paragraph_size)
+    logging.info("Loaded %d train and %d val examples (%d and %d unique paragraphs): %.1f MB, peak RSS %.1f MB" % (
+        len(dataset["train"]), len(dataset["val"]), len(dataset["train"].contexts), len(dataset["val"].contexts),
+        (dataset["train"].nbytes() + dataset["val"].nbytes()) / 2**20,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10))
 
     embed_path = FLAGS.embed_path or pjoin("data", "squad", "glove.trimmed.{}.npz".format(FLAGS.embedding_size))
     FLAGS.embed_path = embed_path
@@ -1,10 +1,14 @@
 import os
 
+import numpy as np
+from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 
 from os.path import join as pjoin
 import logging
 
+from dataset import Dataset
+
 
 def initialize_model(session, model, train_dir):
     ckpt = tf.train.get_checkpoint_state(train_dir)
@@ -12,10 +16,11 @@ def initialize_model(session, model, train_dir):
     if ckpt and (tf.gfile.Exists(ckpt.model_checkpoint_path) or tf.gfile.Exists(v2_path)):
         logging.info("Reading model parameters from %s" % ckpt.model_checkpoint_path)
         model.saver.restore(session, ckpt.model_checkpoint_path)
+        model.initialize_embeddings(session)    # Not in the checkpoint
     else:
         logging.info("No checkpoints found in " + train_dir)
         logging.info("Created model with fresh parameters.")
-        session.run(tf.global_variables_initializer())
+        session.run(tf.global_variables_initializer(), model.embedding_feed())
         logging.info('Num params: %d' % sum(v.get_shape().num_elements() for v in tf.trainable_variables()))
     return model
 
@@ -81,44 +86,133 @@ def pad_inputs(data, max_length):
             mask_data.append([1]*length + [0]*pad_length)
     return padded_data, mask_data
 
+def trim_to_longest(padded_data, mask_data):
+    """
+    Cuts off the trailing columns that are padding in every row, so a batch is only
+    as wide as its longest sequence
+    """
+    padded_data = np.array(list(padded_data))
+    mask_data = np.array(list(mask_data))
+    longest = max(int(np.max(np.sum(mask_data, axis = 1))), 1)
+    return padded_data[:, :longest], mask_data[:, :longest]
+
+def build_ragged_cache(filename, as_bytes=False):
+    """
+    One-time conversion of a line-per-example file into {filename}.tokens.npy, holding every
+    line back to back (int32 ids, or the raw bytes when as_bytes is set), and
+    {filename}.offsets.npy, where line i is tokens[offsets[i]:offsets[i+1]].
+    Files are written under temporary names and renamed, so concurrent runs never see half a cache.
+    """
+    if not tf.gfile.Exists(filename):
+        raise ValueError("Data file %s not found." % filename)
+    logging.info("Building binary cache for %s" % filename)
+
+    lines, lengths = [], []
+    with open(filename, mode="rb") as f:
+        for line in f:
+            line = line.rstrip(b'\n')
+            values = np.frombuffer(line, dtype=np.uint8) if as_bytes else np.fromstring(line, dtype=np.int32, sep=' ')
+            lines.append(values)
+            lengths.append(len(values))
+    tokens = np.concatenate(lines) if lines else np.zeros(0, dtype=np.uint8 if as_bytes else np.int32)
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    for suffix, array in [(".tokens.npy", tokens), (".offsets.npy", offsets)]:
+        tmp_path = "%s%s.%d.tmp" % (filename, suffix, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.rename(tmp_path, filename + suffix)
+
+def load_ragged(filename, as_bytes=False):
+    """
+    Memory-maps the binary cache of filename (building it if it is missing or older than
+    the file), so processes reading the same data share one copy in the page cache.
+
+    :return: (tokens, offsets) read-only arrays as written by build_ragged_cache
+    """
+    tokens_path, offsets_path = filename + ".tokens.npy", filename + ".offsets.npy"
+    if not (os.path.exists(tokens_path) and os.path.exists(offsets_path)) or \
+            os.path.getmtime(offsets_path) < os.path.getmtime(filename):
+        build_ragged_cache(filename, as_bytes)
+    return np.load(tokens_path, mmap_mode='r'), np.load(offsets_path, mmap_mode='r')
+
+def load_embeddings(embed_path):
+    """
+    Memory-maps {embed_path}.f32.npy, an uncompressed float32 copy of the 'glove' matrix in the
+    npz written by qa_data.py, converting it first if it is missing or older than the npz.
+
+    :return: read-only [vocab_size, embedding_size] float32 array
+    """
+    cache_path = embed_path + ".f32.npy"
+    if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(embed_path):
+        logging.info("Building float32 embedding cache for %s" % embed_path)
+        tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.load(embed_path)['glove'].astype(np.float32))
+        os.rename(tmp_path, cache_path)
+    return np.load(cache_path, mmap_mode='r')
+
+def pad_ragged(tokens, offsets, max_length, chunk_rows=8192, out=None):
+    """
+    Vectorized pad_inputs for a (tokens, offsets) pair, chunk_rows lines at a time so the
+    index temporaries stay small next to the result
+
+    :param out: zeroed int32 [num_lines, max_length] array to pad into (default: a new one)
+    :return: (padded, lengths) int32 arrays of shape [num_lines, max_length] and [num_lines]
+    """
+    lengths = np.minimum(np.diff(offsets), max_length).astype(np.int32)
+    padded = np.zeros((len(lengths), max_length), dtype=np.int32) if out is None else out
+    for start in xrange(0, len(lengths), chunk_rows):
+        chunk_lengths = lengths[start : start + chunk_rows]
+        kept = np.arange(max_length)[None, :] < chunk_lengths[:, None]
+
+        # Position of every kept token in the flat array: its line's offset plus its column
+        row_starts = np.cumsum(chunk_lengths) - chunk_lengths
+        columns = np.arange(np.sum(chunk_lengths)) - np.repeat(row_starts, chunk_lengths)
+        padded[start : start + chunk_rows][kept] = tokens[np.repeat(offsets[start : start + len(chunk_lengths)], chunk_lengths) + columns]
+    return padded, lengths
+
+def load_padded(filename, max_length):
+    """
+    Memory-maps {filename}.pad{max_length}.npy, the lines of filename padded (or cut) to
+    max_length by pad_ragged, building it from the ragged cache if it is missing or older,
+    so processes share the padded matrix in the page cache too.
+
+    :return: (padded, lengths): read-only int32 [num_lines, max_length] array, int32 [num_lines]
+    """
+    tokens, offsets = load_ragged(filename)
+    padded_path = "%s.pad%d.npy" % (filename, max_length)
+    if not os.path.exists(padded_path) or os.path.getmtime(padded_path) < os.path.getmtime(filename + ".offsets.npy"):
+        logging.info("Building padded cache %s" % padded_path)
+        tmp_path = "%s.%d.tmp" % (padded_path, os.getpid())
+        # Padded straight into the file, which starts out as zeros, so it is never all in memory
+        padded = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.int32, shape=(len(offsets) - 1, max_length))
+        pad_ragged(tokens, offsets, max_length, out=padded)
+        padded.flush()
+        del padded
+        os.rename(tmp_path, padded_path)
+    return np.load(padded_path, mmap_mode='r'), np.minimum(np.diff(offsets), max_length).astype(np.int32)
+
 def get_dataset(data_dir, max_question_size, max_paragraph_size):
+    """
+    Loads the train and val tiers from their memory-mapped binary caches (see load_ragged and
+    load_padded); only the lengths and the answer text are read into memory.
+    {tier}.ids.context holds each paragraph once and {tier}.context_id the paragraph of each question.
 
-    train_questions_path = os.path.join(data_dir, "train.ids.question")
-    train_answer_path = os.path.join(data_dir, "train.answer")
-    train_span_path = os.path.join(data_dir, "train.span")
-    train_context_path = os.path.join(data_dir, "train.ids.context")
-    val_questions_path = os.path.join(data_dir, "val.ids.question")
-    val_answer_path = os.path.join(data_dir, "val.answer")
-    val_span_path = os.path.join(data_dir, "val.span")
-    val_context_path = os.path.join(data_dir, "val.ids.context")
-
-    train_questions = convert_to_vocab_number(train_questions_path)
-    train_span = convert_to_vocab_number(train_span_path)
-    train_context = convert_to_vocab_number(train_context_path)
-    val_questions = convert_to_vocab_number(val_questions_path)
-    val_span = convert_to_vocab_number(val_span_path)
-    val_context = convert_to_vocab_number(val_context_path)
-
-    train_answer = convert_to_vocab_number_except_dont(train_answer_path)
-    val_answer = convert_to_vocab_number_except_dont(val_answer_path)
-
-    train_questions_padded, train_questions_mask = pad_inputs(train_questions, max_question_size)
-    train_context_padded, train_context_mask = pad_inputs(train_context, max_paragraph_size)
-    val_questions_padded, val_questions_mask = pad_inputs(val_questions, max_question_size)
-    val_context_padded, val_context_mask = pad_inputs(val_context, max_paragraph_size)
-
-    return {"train_questions": train_questions_padded,
-            "train_questions_mask":train_questions_mask,
-            "train_context": train_context_padded,
-            "train_context_mask":train_context_mask,
-            "train_answer": train_answer,
-            "train_span": train_span,
-            "val_questions": val_questions_padded,
-            "val_questions_mask":val_questions_mask,
-            "val_context": val_context_padded,
-            "val_context_mask":val_context_mask,
-            "val_answer": val_answer,
-            "val_span": val_span}
+    :return: dict of tier name ("train", "val") to Dataset
+    """
+    dataset = {}
+    for tier in ["train", "val"]:
+        questions, question_lengths = load_padded(os.path.join(data_dir, tier + ".ids.question"), max_question_size)
+        contexts, context_lengths = load_padded(os.path.join(data_dir, tier + ".ids.context"), max_paragraph_size)
+        context_ids, _ = load_ragged(os.path.join(data_dir, tier + ".context_id"))
+        span_tokens, _ = load_ragged(os.path.join(data_dir, tier + ".span"))
+        answer_tokens, answer_offsets = load_ragged(os.path.join(data_dir, tier + ".answer"), as_bytes=True)
+
+        dataset[tier] = Dataset(questions, question_lengths, contexts, context_lengths, context_ids,
+                                np.reshape(span_tokens, [-1, 2]), answer_tokens.tobytes(),
+                                answer_offsets[:-1], answer_offsets[1:])
+    return dataset
 
 
 def variable_summaries(var):